@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+'''
+Benchmark the blackhole listener's connection rate and response latency.
+
+Starts internet.py --listen on unprivileged ports, then opens connections from
+several client threads: plain HTTP requests, and TLS connections that send a
+ClientHello with a server name. Reports connections per second and p50/p99 time
+from connect until the listener answers or closes. The listener is stopped with
+SIGTERM and the hits file is checked against the connections made.
+
+Usage:
+$ ./benchmarks/listener.py [--connections N] [--clients N]
+'''
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'internet.py'))
+ADDRESS = '127.0.0.250'
+PORTS = (18080, 18443)
+DOMAINS = ['site{0}.example.com'.format(index) for index in range(20)]
+
+def client_hello(name):
+
+	# Return the first bytes of a TLS handshake for name, without finishing it
+	incoming = ssl.MemoryBIO()
+	outgoing = ssl.MemoryBIO()
+	context = ssl.create_default_context()
+	tls = context.wrap_bio(incoming, outgoing, server_hostname=name)
+	try:
+		tls.do_handshake()
+	except ssl.SSLWantReadError:
+		pass
+	return outgoing.read()
+
+def connect(index, hellos):
+
+	# Make one connection, return seconds until the listener answered
+	domain = DOMAINS[index % len(DOMAINS)]
+	tls = index % 2 == 1
+	start = time.time()
+	connection = socket.create_connection((ADDRESS, PORTS[1] if tls else PORTS[0]), timeout=5)
+	if tls:
+		connection.sendall(hellos[domain])
+	else:
+		connection.sendall('GET / HTTP/1.1\r\nHost: {0}\r\n\r\n'.format(domain).encode('ascii'))
+	response = connection.recv(4096)
+	elapsed = time.time() - start
+	connection.close()
+	if not tls and not response.startswith(b'HTTP/1.1 204'):
+		raise ValueError('Unexpected response: {0!r}'.format(response))
+	return elapsed
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark internet.py --listen.')
+	parser.add_argument('--connections', default=20000, type=int, help='Total number of connections.')
+	parser.add_argument('--clients', default=8, type=int, help='Number of client threads.')
+	options = parser.parse_args()
+	if not hasattr(ssl, 'MemoryBIO'):
+		print('Python 3.5 or later is needed to make TLS ClientHellos')
+		sys.exit(1)
+
+	workdir = tempfile.mkdtemp(prefix='internet-listener-')
+	listener = None
+	try:
+		cache_dir = os.path.join(workdir, 'internet.cache')
+		listener = subprocess.Popen([sys.executable, SCRIPT, '--listen', '--listen-ports', '{0},{1}'.format(*PORTS), '--file', os.path.join(workdir, 'internet.json'), '--conf-dir', os.path.join(workdir, 'internet.d'), '--cache-dir', cache_dir], stdout=subprocess.PIPE)
+		listener.stdout.readline()
+
+		hellos = dict((domain, client_hello(domain)) for domain in DOMAINS)
+		latencies = []
+		errors = []
+		lock = threading.Lock()
+
+		def work(indexes):
+			for index in indexes:
+				try:
+					elapsed = connect(index, hellos)
+				except Exception as error:
+					with lock:
+						errors.append(error)
+					continue
+				with lock:
+					latencies.append(elapsed)
+
+		threads = [threading.Thread(target=work, args=(range(client, options.connections, options.clients),)) for client in range(options.clients)]
+		start = time.time()
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		elapsed = time.time() - start
+
+		listener.send_signal(signal.SIGTERM)
+		listener.wait()
+		listener = None
+		f = open(os.path.join(cache_dir, 'hits.json'), 'r')
+		hits = json.loads(f.read())['hits']
+		f.close()
+
+		latencies.sort()
+		print('Connections:    {0} from {1} clients, {2} errors'.format(len(latencies), options.clients, len(errors)))
+		print('Rate:           {0:.0f} connections/second'.format(len(latencies) / elapsed))
+		print('Latency:        p50 {0:.2f}ms, p99 {1:.2f}ms'.format(latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
+		print('Hits counted:   {0} on {1} domains'.format(sum(hits.values()), len(hits)))
+
+		if errors or sum(hits.values()) != len(latencies) or set(hits) != set(DOMAINS):
+			print('\nFAIL')
+			sys.exit(1)
+		print('\nOK')
+	finally:
+		if listener:
+			listener.kill()
+		shutil.rmtree(workdir, True)
+
+if __name__ == '__main__':
+	main()
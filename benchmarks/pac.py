@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+'''
+Benchmark PAC file evaluation cost against block list size.
+
+Generates groups of increasing size, writes a PAC file for each with
+internet.py --pac, then times FindProxyForURL() for a mix of blocked hosts,
+blocked subdomains and unblocked hosts. For comparison the same list is also
+timed as a chain of dnsDomainIs() checks, the usual way PAC files are written.
+
+PAC files are evaluated with node when it is installed. Otherwise the lookup is
+emulated in Python, which shows the same scaling but not browser timings.
+
+Usage:
+$ ./benchmarks/pac.py [sizes...]
+'''
+
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'internet.py'))
+SIZES = [100, 1000, 10000, 100000]
+LOOKUPS = 20000
+
+# The naive chain is only timed for about this many domain checks
+NAIVE_CHECKS = 20000000
+
+NODE_BENCHMARK = '''
+var fs = require('fs');
+var dnsDomainIs = function(host, domain) {
+	return host.length >= domain.length && host.substring(host.length - domain.length) == domain;
+};
+var run = function(source, hosts) {
+	var FindProxyForURL = new Function('dnsDomainIs', source + '; return FindProxyForURL;')(dnsDomainIs);
+	var start = process.hrtime();
+	for (var i = 0; i < hosts.length; i++) {
+		FindProxyForURL('', hosts[i]);
+	}
+	var elapsed = process.hrtime(start);
+	return (elapsed[0] * 1e9 + elapsed[1]) / hosts.length;
+};
+var hosts = JSON.parse(fs.readFileSync(process.argv[4], 'utf8'));
+console.log(JSON.stringify([
+	run(fs.readFileSync(process.argv[2], 'utf8'), hosts),
+	run(fs.readFileSync(process.argv[3], 'utf8'), hosts.slice(0, parseInt(process.argv[5], 10)))
+]));
+'''
+
+def naive_pac(domains):
+
+	# The usual hand written PAC file, one check per domain
+	checks = '\n'.join(['\tif (host == "{0}" || dnsDomainIs(host, ".{0}")) return "PROXY 127.0.0.250:80";'.format(domain) for domain in domains])
+	return 'function FindProxyForURL(url, host) {\n' + checks + '\n\treturn "DIRECT";\n}\n'
+
+def naive_sample(domains):
+	return max(100, NAIVE_CHECKS // max(1, len(domains)))
+
+def emulate(pac, domains, hosts):
+
+	# Python equivalents of the generated and the naive PAC files
+	blocked = json.loads(re.search('var blocked = (.*);', pac).group(1))
+
+	def hashed(host):
+		name = host.lower()
+		while True:
+			if name in blocked:
+				return True
+			dot = name.find('.')
+			if dot < 0:
+				return False
+			name = name[dot + 1:]
+
+	def naive(host):
+		for domain in domains:
+			if host == domain or host.endswith('.' + domain):
+				return True
+		return False
+
+	results = []
+	for function in (hashed, naive):
+		sample = hosts if function is hashed else hosts[:naive_sample(domains) // 10]
+		start = time.time()
+		for host in sample:
+			function(host)
+		results.append((time.time() - start) / len(sample) * 1e9)
+	return results
+
+def main():
+	sizes = [int(size) for size in sys.argv[1:]] or SIZES
+	node = None
+	for name in ('node', 'nodejs'):
+		for directory in os.environ.get('PATH', '').split(os.pathsep):
+			if os.path.exists(os.path.join(directory, name)):
+				node = os.path.join(directory, name)
+				break
+		if node:
+			break
+
+	random.seed(0)
+	workdir = tempfile.mkdtemp(prefix='internet-pac-')
+	try:
+		print('Evaluating with: {0}'.format(node or 'python emulation'))
+		print('{0:>10} {1:>12} {2:>12} {3:>16} {4:>16}'.format('domains', 'pac bytes', 'generate s', 'hashed ns/call', 'naive ns/call'))
+		for size in sizes:
+
+			# Write a config with one group of random domains
+			domains = ['site{0}.example{1}.com'.format(random.randint(0, size * 10), index % 13) for index in range(size)]
+			domains = sorted(set(domains))
+			config = os.path.join(workdir, 'internet.json')
+			f = open(config, 'w')
+			json.dump({'active': ['default'], 'groups': {'default': {'hours': ['*'], 'days': ['*'], 'domains': domains}}}, f)
+			f.close()
+
+			# Mix of blocked hosts, blocked subdomains and unblocked hosts
+			hosts = []
+			for index in range(LOOKUPS):
+				choice = index % 3
+				if choice == 0:
+					hosts.append(random.choice(domains))
+				elif choice == 1:
+					hosts.append('www.cdn.' + random.choice(domains))
+				else:
+					hosts.append('www.unblocked{0}.org'.format(index))
+
+			pac = os.path.join(workdir, 'internet.pac')
+			start = time.time()
+			subprocess.check_call([sys.executable, SCRIPT, '--file', config, '--conf-dir', os.path.join(workdir, 'internet.d'), '--cache-dir', os.path.join(workdir, 'internet.cache'), '--pac', pac])
+			generate = time.time() - start
+			f = open(pac, 'r')
+			pac_source = f.read()
+			f.close()
+
+			if node:
+				naive = os.path.join(workdir, 'naive.pac')
+				f = open(naive, 'w')
+				f.write(naive_pac(domains))
+				f.close()
+				hosts_file = os.path.join(workdir, 'hosts.json')
+				f = open(hosts_file, 'w')
+				json.dump(hosts, f)
+				f.close()
+				benchmark = os.path.join(workdir, 'benchmark.js')
+				f = open(benchmark, 'w')
+				f.write(NODE_BENCHMARK)
+				f.close()
+				output = subprocess.check_output([node, benchmark, pac, naive, hosts_file, str(naive_sample(domains))])
+				(hashed, naive) = json.loads(output.decode('utf-8'))
+			else:
+				(hashed, naive) = emulate(pac_source, domains, hosts)
+
+			print('{0:>10} {1:>12} {2:>12.3f} {3:>16.0f} {4:>16.0f}'.format(len(domains), len(pac_source), generate, hashed, naive))
+	finally:
+		shutil.rmtree(workdir, True)
+
+if __name__ == '__main__':
+	main()
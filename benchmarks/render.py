@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+'''
+Check that every way of rendering the hosts file gives the same output, and
+that peak memory follows the render budget.
+
+Writes a config of overlapping groups, then updates a temporary hosts file by
+each render path:
+- in memory, with no usable cache directory and a budget above the list size
+- sorted on disk, with no usable cache directory and a small budget
+- from the sorted cache of each group
+- from a hosts file compiled with --compile
+The outputs must be byte for byte the same. Peak memory of the in memory and on
+disk runs is compared to show how much the budget saves, after loading the
+groups, which every path needs.
+
+Usage:
+$ ./benchmarks/render.py [--groups N] [--domains N] [--budget N]
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'internet.py'))
+
+def run(command):
+
+	# Run command, return its peak resident memory in MB
+	devnull = open(os.devnull, 'w')
+	process = subprocess.Popen(command, stdout=devnull)
+	(_, status, usage) = os.wait4(process.pid, 0)
+	devnull.close()
+	process.returncode = status
+	if status != 0:
+		raise subprocess.CalledProcessError(status, command)
+
+	# ru_maxrss is in kilobytes on Linux and bytes on Mac OS X
+	return usage.ru_maxrss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+def md5(path):
+	f = open(path, 'rb')
+	digest = hashlib.md5(f.read()).hexdigest()
+	f.close()
+	return digest
+
+def main():
+	parser = argparse.ArgumentParser(description='Check internet.py render paths and render budget memory use.')
+	parser.add_argument('--groups', default=4, type=int, help='Number of groups.')
+	parser.add_argument('--domains', default=500000, type=int, help='Domains per group.')
+	parser.add_argument('--budget', default=100000, type=int, help='Render budget of the on disk run.')
+	options = parser.parse_args()
+
+	workdir = tempfile.mkdtemp(prefix='internet-render-')
+	try:
+		# Each group shares half of its domains with the next one
+		groups = {}
+		for index in range(options.groups):
+			start = index * options.domains // 2
+			groups['group{0}'.format(index)] = {'hours': ['*'], 'days': ['*'], 'domains': ['site{0}.example{1}.com'.format(number, number % 7) for number in range(start, start + options.domains)]}
+		config = os.path.join(workdir, 'internet.json')
+		f = open(config, 'w')
+		json.dump({'active': sorted(groups), 'groups': groups}, f)
+		f.close()
+		groups = None
+
+		hosts = os.path.join(workdir, 'hosts')
+		f = open(hosts, 'w')
+		f.write('127.0.0.1\tlocalhost\n')
+		f.close()
+		base = [sys.executable, SCRIPT, '--update', '--hosts-file', hosts, '--file', config, '--conf-dir', os.path.join(workdir, 'internet.d')]
+
+		# A file as the cache directory leaves it unusable
+		no_cache = ['--cache-dir', os.path.join(config, 'cache')]
+		cache = ['--cache-dir', os.path.join(workdir, 'internet.cache')]
+		total = options.groups * options.domains
+
+		# Baseline: load the groups without rendering
+		baseline = run([sys.executable, SCRIPT, '--list', '--group', 'none', '--file', config, '--conf-dir', os.path.join(workdir, 'internet.d')] + no_cache)
+
+		results = []
+		for (name, arguments) in (
+			('in memory', no_cache + ['--render-budget', str(total)]),
+			('on disk', no_cache + ['--render-budget', str(options.budget)]),
+			('group cache', cache + ['--render-budget', str(total)]),
+			('compiled', cache + ['--compile'])):
+			peak = run(base + arguments)
+			results.append((name, peak, md5(hosts)))
+
+		print('{0} groups of {1} domains, render budget {2} for on disk\n'.format(options.groups, options.domains, options.budget))
+		print('{0:<12} {1:>10} {2:>14}  {3}'.format('path', 'peak MB', 'over load MB', 'md5'))
+		print('{0:<12} {1:>10.1f} {2:>14}'.format('load only', baseline, ''))
+		for (name, peak, digest) in results:
+			print('{0:<12} {1:>10.1f} {2:>14.1f}  {3}'.format(name, peak, peak - baseline, digest))
+
+		failed = False
+		if len(set(digest for (_, _, digest) in results)) != 1:
+			print('\nRender paths gave different hosts files')
+			failed = True
+
+		# Rendering on disk should need well under half the memory over
+		# loading that rendering in memory does
+		in_memory = results[0][1] - baseline
+		on_disk = results[1][1] - baseline
+		if on_disk > in_memory / 2:
+			print('\nOn disk rendering used {0:.1f}MB over loading, in memory {1:.1f}MB'.format(on_disk, in_memory))
+			failed = True
+
+		if failed:
+			print('\nFAIL')
+			sys.exit(1)
+		print('\nOK')
+	finally:
+		shutil.rmtree(workdir, True)
+
+if __name__ == '__main__':
+	main()
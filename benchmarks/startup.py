@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+'''
+Benchmark startup time of cron job runs against a budget.
+
+Runs internet.py --cron against a temporary hosts file and config, and reports
+the median time over the interpreter's own startup time. Exits with an error if
+the overhead is over budget, or if a module that cron runs should not need is
+imported, so startup regressions are caught.
+
+Imports are listed with -X importtime where the interpreter supports it (Python
+3.7 and later), and with -v otherwise.
+
+Usage:
+$ ./benchmarks/startup.py [--runs N] [--budget MS]
+'''
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'internet.py'))
+
+# Milliseconds a cron run may take over the interpreter's own startup time
+BUDGET = 50
+
+# Modules a cron run with unchanged config should never import
+SLOW_MODULES = ['argparse', 'json', 'multiprocessing', 'pprint', 'shutil', 'subprocess', 'tempfile']
+
+def median(command, runs):
+	devnull = open(os.devnull, 'w')
+	times = []
+	for _ in range(runs):
+		start = time.time()
+		subprocess.check_call(command, stdout=devnull, stderr=devnull)
+		times.append(time.time() - start)
+	devnull.close()
+	times.sort()
+	return times[len(times) // 2] * 1000
+
+def imports(command):
+
+	# Return (module, cumulative microseconds or None) for each import
+	if sys.version_info >= (3, 7):
+		output = subprocess.check_output([command[0], '-X', 'importtime'] + command[1:], stderr=subprocess.STDOUT).decode('utf-8')
+		found = re.findall(r'import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)', output)
+		return [(name, int(cumulative)) for (cumulative, name) in found]
+	output = subprocess.check_output([command[0], '-v'] + command[1:], stderr=subprocess.STDOUT).decode('utf-8')
+	return [(name, None) for name in re.findall(r'^import (\S+) ', output, re.MULTILINE)]
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark internet.py --cron startup time.')
+	parser.add_argument('--runs', default=20, type=int, help='Number of runs to take the median of.')
+	parser.add_argument('--budget', default=BUDGET, type=float, help='Allowed milliseconds over interpreter startup.')
+	options = parser.parse_args()
+
+	workdir = tempfile.mkdtemp(prefix='internet-startup-')
+	try:
+		hosts = os.path.join(workdir, 'hosts')
+		f = open(hosts, 'w')
+		f.write('127.0.0.1\tlocalhost\n')
+		f.close()
+		config = os.path.join(workdir, 'internet.json')
+		f = open(config, 'w')
+		json.dump({'active': ['default'], 'groups': {'default': {'hours': ['*'], 'days': ['*'], 'domains': ['site{0}.example.com'.format(index) for index in range(1000)]}}}, f)
+		f.close()
+		command = [sys.executable, SCRIPT, '--cron', '--hosts-file', hosts, '--file', config, '--conf-dir', os.path.join(workdir, 'internet.d'), '--cache-dir', os.path.join(workdir, 'internet.cache')]
+
+		# The first run fills the caches, like the first cron run after a change
+		subprocess.check_call(command, stdout=open(os.devnull, 'w'))
+
+		interpreter = median([sys.executable, '-c', 'pass'], options.runs)
+		cron = median(command, options.runs)
+		overhead = cron - interpreter
+		print('Interpreter startup: {0:.1f}ms'.format(interpreter))
+		print('internet.py --cron:  {0:.1f}ms'.format(cron))
+		print('Overhead:            {0:.1f}ms (budget {1:.1f}ms)'.format(overhead, options.budget))
+
+		found = imports(command)
+		timed = sorted([item for item in found if item[1] is not None], key=lambda item: -item[1])
+		if timed:
+			print('\nSlowest imports (cumulative):')
+			for (name, cumulative) in timed[:10]:
+				print('  {0:>8.1f}ms  {1}'.format(cumulative / 1000.0, name))
+		slow = sorted(set(name for (name, _) in found if name.split('.')[0] in SLOW_MODULES))
+		if slow:
+			print('\nUnexpected imports: {0}'.format(', '.join(slow)))
+
+		if overhead > options.budget or slow:
+			print('\nFAIL')
+			sys.exit(1)
+		print('\nOK')
+	finally:
+		shutil.rmtree(workdir, True)
+
+if __name__ == '__main__':
+	main()
@@ -124,7 +124,7 @@ $ ./internet.py --empty domains --group 'work'
 
 _Notice_ This script only supports single arguments, e.g. one --domain, --hour
 or --day args. To add multiple domains, you must call internet.py multiple
-times
+times, or use a batch file (see Batch actions below).
 
 Days
 --------------------------------------------------------------------------------
@@ -166,6 +166,52 @@ $ ./internet.py --add --hour 9-17
 Empty all hours in a group
 $ ./internet.py --empty hours --group 'work'
 
+Batch actions
+--------------------------------------------------------------------------------
+Many actions can be applied at once from a batch file with --batch. Each line is
+a json object with an 'action' of add, remove, empty, activate or deactivate,
+and the same fields as the command line flags: 'group', 'domain', 'hour', 'day',
+and 'field' for empty. Blank lines and lines starting with '#' are skipped.
+
+The syntax and fields of every line are checked before any action is applied,
+and nothing is applied if a line is invalid. Actions that fail when applied,
+e.g. activating a group that doesn't exist, are reported and skipped, and the
+actions on the other lines are still applied. The json storage file is saved
+once and the hosts file is updated once for the whole batch. A result is printed
+for each line, followed by the total time taken. The exit status is 1 if any
+action failed.
+
+Example batch file:
+
+{"action": "add", "group": "work", "domain": "google.com"}
+{"action": "add", "group": "work", "hour": "9-17"}
+{"action": "empty", "group": "social", "field": "domains"}
+
+Apply a batch file
+$ ./internet.py --batch actions.jsonl
+
+Apply a batch read from stdin
+$ cat actions.jsonl | ./internet.py --batch -
+
+Drop-in directory
+--------------------------------------------------------------------------------
+Groups can also be split across json files in the internet.d directory next to
+the script (see --conf-dir). Each file uses the same layout as internet.json,
+with its own 'groups' and 'active' lists. Files are merged with internet.json
+in file name order. A group defined in more than one place gets all of their
+hours, days and domains.
+
+Groups defined in internet.d are read-only from the command line. Edit the file
+that owns the group instead.
+
+The merged result is cached in the internet.cache directory (see --cache-dir).
+If no file in internet.d changed since the last run, they are not parsed again.
+
+Example:
+
+List groups from internet.json and a custom drop-in directory
+$ ./internet.py --list --conf-dir /etc/internet.d
+
 Misc
 --------------------------------------------------------------------------------
 There are more commands and functionality than outlined here. Run the help
@@ -176,12 +222,67 @@ Examples:
 List current groups and their status
 $ ./internet.py --list
 
+Show how many domains each group shares with other groups, and the overlap
+between each pair of groups. A group with no unique domains adds nothing to the
+hosts file and can be removed.
+$ ./internet.py --stats
+
 View the hosts file before updating it
 $ ./internet.py --update --confirm
 
+Update the hosts file sorting at most 100000 domains in memory at a time. Larger
+lists are sorted in parts on disk, using all processors, then merged. The sorted
+domains of each group are cached in internet.cache, so only groups that changed
+since the last update are sorted again. See benchmarks/render.py for peak
+memory against the budget.
+$ ./internet.py --update --render-budget 100000
+
 Print crontab information
 $ ./internet.py --print-crontab
 
+Render the hosts file for every hour of the week ahead of time. Groups only
+change by hour and day, so the week has a handful of distinct hosts files. Each
+is rendered once into internet.cache/compiled, and later updates swap in the one
+for the current hour. They are compiled again when internet.json, internet.d
+or /etc/hosts.template change. Remove internet.cache/compiled to go back to
+rendering on every update.
+$ ./internet.py --compile
+
+Check that blocked domains now resolve to the blackhole address. Resolves a
+random sample of 50 blocked domains at once and reports any that don't, along
+with resolution times. Use --sample 0 to check every blocked domain. See
+tests/test_verify.py for verifying against a stand-in resolver.
+$ ./internet.py --update --verify --sample 200
+
+Update a different hosts file. The original and template files are kept next to
+it, e.g. /tmp/hosts.template.
+$ ./internet.py --update --hosts-file /tmp/hosts
+
+Cron jobs and plain updates are kept fast to start: they skip building the full
+argument parser, only import what they use, and load internet.json from a
+snapshot in internet.cache when it has not changed. See benchmarks/startup.py
+for the startup time budget.
+
+Write a proxy auto-config (PAC) file for machines where /etc/hosts can't be
+changed. It blocks the same domains as the hosts file, and their subdomains.
+Run it from cron like --update to keep it current. See benchmarks/pac.py for
+evaluation cost against list size.
+$ ./internet.py --pac /var/www/internet.pac
+
+Keep running and update the hosts file as soon as internet.json, internet.d or
+/etc/hosts.template change, and at the start of every hour. Uses inotify on
+Linux and checks the files every second elsewhere.
+$ ./internet.py --watch
+
+Answer connections to the blackhole address at once, instead of leaving
+browsers to time out, and count hits per blocked domain. Plain HTTP gets an
+empty response and HTTPS connections are closed as soon as the requested name
+is read. Hits are added to internet.cache/hits.json every minute. Listening on
+ports 80 and 443 requires root. See benchmarks/listener.py for connection rate
+and latency.
+$ ./internet.py --listen
+$ ./internet.py --listen --listen-ports 8080,8443
+
 _Remember_ this script modifies the /etc/hosts file, which requires root
 privileges. Most command options require using sudo.
 
@@ -313,34 +414,710 @@ license below is the basic MIT plus the MIT X11 and MIT XFree86 Project clauses:
 http://en.wikipedia.org/wiki/MIT_License
 '''
 
-import argparse
-import json
+# Only modules needed by every run are imported here. Everything else is
+# imported where it is used, so cron jobs and plain updates start quickly.
+import marshal
 import os
-import pprint
-import re
-import shutil
 import sys
+import time
 
 from datetime import datetime
-from subprocess import call
+
+# Multiprocessing helpers
+# Pool workers must be module level functions so they can be pickled
+
+def _pool(processes=None):
+	import multiprocessing
+
+	# Always fork workers. Spawned workers would import this script again, and
+	# could not inherit data from the parent, e.g. runs for _write_run().
+	try:
+		context = multiprocessing.get_context('fork')
+	except AttributeError:
+		context = multiprocessing
+	return context.Pool(processes)
+
+def _pool_process(target, args):
+	import multiprocessing
+
+	# Return a forked process, see _pool() above
+	try:
+		context = multiprocessing.get_context('fork')
+	except AttributeError:
+		context = multiprocessing
+	return context.Process(target=target, args=args)
+
+def _read_fragment(path):
+	import json
+
+	# Return parsed fragment as marshal data, which is much cheaper to send back
+	# to the parent process than the parsed objects themselves.
+	try:
+		f = open(path, 'r')
+		file_contents = f.read()
+		f.close()
+		return (path, marshal.dumps(json.loads(file_contents)))
+	except (IOError, ValueError):
+		return (path, None)
+
+def _write_run(domains, path):
+
+	# Sort and deduplicate one run of domains, one per line. Runs are written by
+	# forked processes, so the domains are inherited instead of pickled.
+	f = open(path, 'wb')
+	for domain in sorted(set(domains)):
+		f.write(domain.encode('utf-8') + b'\n')
+	f.close()
+
+def _merge_runs(paths):
+	import heapq
+
+	# Yield unique domains from sorted runs in order
+	files = [open(path, 'rb') for path in paths]
+	try:
+		previous = None
+		for line in heapq.merge(*files):
+			if line != previous:
+				previous = line
+				yield line[:-1]
+	finally:
+		for f in files:
+			f.close()
+
+# Data model
+# Groups are kept as sets while the script runs and converted back to the json
+# storage layout, in sorted order, when saved.
+
+class Group(object):
+
+	__slots__ = ('hours', 'domains', 'days', 'checksum')
+
+	days_map = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+	def __init__(self, hours=('*',), domains=(), days=('*',)):
+		self.hours = set(hours)
+		self.domains = set(Group.normalize(domain) for domain in domains)
+		self.days = set(days)
+		self.checksum = None
+
+	@classmethod
+	def from_json(cls, data):
+		return cls(data.get('hours', []), data.get('domains', []), data.get('days', []))
+
+	@classmethod
+	def from_snapshot(cls, data):
+
+		# Snapshots are already normalized, skip __init__
+		group = cls.__new__(cls)
+		(group.hours, group.domains, group.days, group.checksum) = data
+		return group
+
+	def to_snapshot(self):
+		return (self.hours, self.domains, self.days, self.digest())
+
+	def to_json(self):
+		return {
+			'hours': sorted(self.hours),
+			'domains': sorted(self.domains),
+			'days': sorted(self.days)
+		}
+
+	@staticmethod
+	def normalize(domain):
+
+		# Domains are stored lowercase without the protocol
+		domain = domain.strip().lower()
+		if domain.startswith('http://'):
+			domain = domain[len('http://'):]
+		return domain
+
+	def digest(self):
+
+		# Order independent checksum of the domains, so the set does not need
+		# to be sorted to tell whether it changed. Sums the first 64 bits of
+		# each domain's md5, weak checksums like adler32 collide for names
+		# as short as 'abba.com' and 'baab.com'. The checksum is kept in
+		# snapshots, and must be reset when domains are changed directly.
+		if self.checksum is not None:
+			return self.checksum
+		import hashlib
+		import struct
+		md5 = hashlib.md5
+		unpack = struct.Struct('<Q').unpack_from
+		total = sum(unpack(md5(domain.encode('utf-8')).digest())[0] for domain in self.domains)
+		self.checksum = '{0:x}-{1:016x}'.format(len(self.domains), total & 0xffffffffffffffff)
+		return self.checksum
+
+	def copy(self):
+		group = Group((), (), ())
+		group.update(self)
+		return group
+
+	def update(self, other):
+		self.hours |= other.hours
+		self.domains |= other.domains
+		self.days |= other.days
+		self.checksum = None
+
+	def add_hour(self, hour):
+
+		# The wildcard replaces all hours, and is replaced by any other hour
+		if hour == '*' or '*' in self.hours:
+			self.hours = set([hour])
+		else:
+			self.hours.add(hour)
+
+	def add_day(self, day):
+
+		# The wildcard replaces all days, and is replaced by any other day
+		if day == '*' or '*' in self.days:
+			self.days = set([day])
+		else:
+			self.days.add(day)
+
+	def hour_mask(self):
+
+		# Return a bitmask of the hours, 0-23, the group is live during.
+		# Ranges include the start hour but not the end hour.
+		if '*' in self.hours:
+			return (1 << 24) - 1
+		mask = 0
+		for hour in self.hours:
+			try:
+				if '-' in hour:
+					(hour_start, _, hour_end) = hour.partition('-')
+					for value in range(int(hour_start), min(int(hour_end), 24)):
+						mask |= 1 << value
+				elif 0 <= int(hour) < 24:
+					mask |= 1 << int(hour)
+			except ValueError:
+				continue
+		return mask
+
+	def day_mask(self):
+
+		# Return a bitmask of the weekdays, Monday is 0, the group is live on
+		if '*' in self.days:
+			return (1 << 7) - 1
+		mask = 0
+		for index, day in enumerate(Group.days_map):
+			if day in self.days:
+				mask |= 1 << index
+		return mask
+
+	def is_live(self, weekday, hour):
+		return bool(self.day_mask() & (1 << weekday)) and bool(self.hour_mask() & (1 << hour))
+
+class Config(object):
+
+	__slots__ = ('groups', 'active')
+
+	def __init__(self, groups=None, active=()):
+		self.groups = groups if groups is not None else {}
+		self.active = set(active)
+
+	@classmethod
+	def from_json(cls, data):
+
+		# Groups are removed from data as they are converted, so the parsed
+		# json and the sets built from it are not held in memory together
+		groups = {}
+		parsed = data.get('groups', {})
+		for name in list(parsed):
+			groups[name] = Group.from_json(parsed.pop(name))
+		return cls(groups, data.get('active', []))
+
+	@classmethod
+	def from_snapshot(cls, data):
+		groups = {}
+		for name, group in data['groups'].items():
+			groups[name] = Group.from_snapshot(group)
+		return cls(groups, data['active'])
+
+	def to_snapshot(self):
+
+		# Snapshots keep sets, which marshal can store and load much faster
+		# than json can be parsed and normalized
+		groups = {}
+		for name, group in self.groups.items():
+			groups[name] = group.to_snapshot()
+		return {'groups': groups, 'active': self.active}
+
+	def to_json(self):
+		groups = {}
+		for name in sorted(self.groups):
+			groups[name] = self.groups[name].to_json()
+		return {
+			'active': sorted(self.active),
+			'groups': groups
+		}
+
+	def domain_index(self):
+
+		# Return the group names in order, and a map of each domain to a
+		# bitmask of the groups listing it, bit n for the nth name. Only used
+		# for reports, building it costs several times a union of the live
+		# groups.
+		names = sorted(self.groups)
+		index = {}
+		get = index.get
+		for bit, name in enumerate(names):
+			mask = 1 << bit
+			for domain in self.groups[name].domains:
+				index[domain] = get(domain, 0) | mask
+		return (names, index)
+
+	def merge(self, other):
+
+		# Groups defined in more than one place get the union of their fields
+		for name, group in other.groups.items():
+			if name in self.groups:
+				self.groups[name].update(group)
+			else:
+				self.groups[name] = group.copy()
+		self.active |= other.active
+		return self
+
+# Watchers
+# Both watchers wait for changes to a set of files, and to json files in a set
+# of directories. wait() returns the changed paths, or an empty set if the
+# timeout passed without changes.
+
+class InotifyWatcher(object):
+
+	# See: $ man inotify
+	IN_MODIFY = 0x00000002
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_FROM = 0x00000040
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_DELETE = 0x00000200
+	IN_Q_OVERFLOW = 0x00004000
+	IN_IGNORED = 0x00008000
+
+	def __init__(self, files, directories):
+		import ctypes
+		import ctypes.util
+		self.files = set(os.path.abspath(path) for path in files)
+		self.directories = set(os.path.abspath(path) for path in directories)
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = self.libc.inotify_init()
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'Could not initialize inotify')
+
+		# Watch parent directories instead of files, so files replaced by
+		# editors and atomic renames are still seen. Watched directories that
+		# don't exist yet are picked up when created in their parent.
+		self.watches = {}
+		for directory in set(os.path.dirname(path) for path in self.files | self.directories) | self.directories:
+			if os.path.isdir(directory):
+				self._watch(directory)
+
+	def _watch(self, directory):
+		import ctypes
+		mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+		wd = self.libc.inotify_add_watch(self.fd, directory.encode('utf-8'), mask)
+		if wd < 0:
+			raise OSError(ctypes.get_errno(), 'Could not watch directory: {0}'.format(directory))
+		self.watches[wd] = directory
+
+	def wait(self, timeout):
+		import select
+		import struct
+
+		changed = set()
+		deadline = time.time() + timeout
+		while not changed:
+			(readable, _, _) = select.select([self.fd], [], [], max(0, deadline - time.time()))
+			if not readable:
+				return changed
+
+			# Each event is a header followed by a null padded file name.
+			# Events for other files in the watched directories are ignored.
+			data = os.read(self.fd, 65536)
+			offset = 0
+			while offset < len(data):
+				(wd, mask, _, length) = struct.unpack_from('iIII', data, offset)
+				name = data[offset + 16:offset + 16 + length].rstrip(b'\0').decode('utf-8', 'replace')
+				offset += 16 + length
+				if mask & self.IN_Q_OVERFLOW:
+					changed |= self.files | self.directories
+					continue
+				if mask & self.IN_IGNORED:
+					self.watches.pop(wd, None)
+					continue
+				path = os.path.join(self.watches.get(wd, ''), name)
+				if path in self.files or (self.watches.get(wd) in self.directories and name.endswith('.json')):
+					changed.add(path)
+
+				# A watched directory was created, or moved in. Files may
+				# already be in it by the time it is watched.
+				elif path in self.directories and mask & (self.IN_CREATE | self.IN_MOVED_TO) and path not in self.watches.values():
+					try:
+						self._watch(path)
+						changed |= set(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.json'))
+					except OSError:
+						continue
+		return changed
+
+class PollingWatcher(object):
+
+	def __init__(self, files, directories, interval):
+		self.files = set(os.path.abspath(path) for path in files)
+		self.directories = set(os.path.abspath(path) for path in directories)
+		self.interval = interval
+		self.snapshot = self._snapshot()
+
+	def _snapshot(self):
+		import glob
+		snapshot = {}
+		paths = list(self.files)
+		for directory in self.directories:
+			paths.extend(glob.glob(os.path.join(directory, '*.json')))
+		for path in paths:
+			try:
+				stat = os.stat(path)
+				snapshot[path] = (stat.st_mtime, stat.st_size, stat.st_ino)
+			except OSError:
+				continue
+		return snapshot
+
+	def wait(self, timeout):
+		deadline = time.time() + timeout
+		while True:
+			snapshot = self._snapshot()
+			changed = set(path for path in set(snapshot) | set(self.snapshot) if snapshot.get(path) != self.snapshot.get(path))
+			self.snapshot = snapshot
+			if changed or time.time() >= deadline:
+				return changed
+			time.sleep(max(0, min(self.interval, deadline - time.time())))
+
+# Blackhole listener
+# Answers connections to the blackhole address at once, so clients don't wait on
+# retries, and counts hits per requested name. Runs in a single thread around
+# poll(), or select() where poll() is not available.
+
+class BlackholeListener(object):
+
+	HTTP_RESPONSE = b'HTTP/1.1 204 No Content\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+	CONNECT_RESPONSE = b'HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+	# Largest request head or TLS ClientHello record read before giving up
+	MAX_REQUEST = 16389
+
+	def __init__(self, address, http_ports, https_ports, timeout):
+		import socket
+		self.timeout = timeout
+		self.servers = {}
+		self.connections = {}
+		self.hits = {}
+		for (ports, tls) in ((http_ports, False), (https_ports, True)):
+			for port in ports:
+				server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+				server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+				server.bind((address, port))
+				server.listen(1024)
+				server.setblocking(False)
+				self.servers[server.fileno()] = (server, tls)
+
+	def run(self, interval, flush):
+
+		# Serve until interrupted, calling flush(hits) with the hits counted
+		# since the last call every interval seconds, and once more at exit
+		import select
+		poller = select.poll() if hasattr(select, 'poll') else None
+		if poller:
+			for fd in self.servers:
+				poller.register(fd, select.POLLIN)
+		next_flush = time.time() + interval
+		next_sweep = time.time() + 1
+		try:
+			while True:
+				if poller:
+					ready = [fd for (fd, _) in poller.poll(1000)]
+				else:
+					(ready, _, _) = select.select(list(self.servers) + list(self.connections), [], [], 1.0)
+				for fd in ready:
+					if fd in self.servers:
+						for connection in self._accept(fd):
+							if poller:
+								poller.register(connection, select.POLLIN)
+					elif fd in self.connections and self._read(fd) and poller:
+						poller.unregister(fd)
+
+				# Once a second, drop connections that never sent a complete
+				# request
+				now = time.time()
+				if now >= next_sweep:
+					for fd in [fd for (fd, state) in self.connections.items() if now - state[3] > self.timeout]:
+						self._finish(fd, None)
+						if poller:
+							poller.unregister(fd)
+					next_sweep = now + 1
+
+				if now >= next_flush:
+					self._flush(flush)
+					next_flush = now + interval
+		finally:
+			self._flush(flush)
+			for fd in list(self.connections):
+				self._finish(fd, None)
+			for (server, _) in self.servers.values():
+				server.close()
+
+	def _flush(self, flush):
+		if self.hits:
+			(hits, self.hits) = (self.hits, {})
+			flush(hits)
+
+	def _accept(self, fd):
+		import socket
+
+		# Accept every pending connection. Returns the new file descriptors.
+		(server, tls) = self.servers[fd]
+		accepted = []
+		while True:
+			try:
+				(connection, _) = server.accept()
+			except socket.error:
+				return accepted
+			connection.setblocking(False)
+			self.connections[connection.fileno()] = [connection, tls, b'', time.time()]
+			accepted.append(connection.fileno())
+
+	def _read(self, fd):
+		import socket
+
+		# Read what the client sent. Returns True once the connection is
+		# answered and closed.
+		state = self.connections[fd]
+		try:
+			data = state[0].recv(4096)
+		except socket.error:
+			return self._finish(fd, None)
+		if not data:
+			return self._finish(fd, self._server_name(state[2]) if state[1] else None)
+		state[2] += data
+		if state[1]:
+			name = self._server_name(state[2])
+			if name is not None or len(state[2]) >= self.MAX_REQUEST:
+				return self._finish(fd, name or '')
+		elif b'\r\n\r\n' in state[2] or len(state[2]) >= self.MAX_REQUEST:
+			(name, connect) = self._host(state[2])
+			return self._finish(fd, name, self.CONNECT_RESPONSE if connect else self.HTTP_RESPONSE)
+		return False
+
+	def _finish(self, fd, name, response=None):
+
+		# Send the response, if any, and close. TLS connections are closed
+		# without one, clients fail fast instead of waiting on a handshake. A
+		# name of None is not counted, '' is counted as '-'.
+		connection = self.connections.pop(fd)[0]
+		if name is not None:
+			name = name.lower().rstrip('.') or '-'
+			self.hits[name] = self.hits.get(name, 0) + 1
+		if response:
+			try:
+				connection.send(response)
+			except Exception:
+				pass
+		connection.close()
+		return True
+
+	@staticmethod
+	def _host(data):
+
+		# Return (host, whether it is a proxy CONNECT request) for a request
+		# head. Requests sent to a PAC file's proxy have the host in the
+		# request line instead of the Host header, e.g. CONNECT example.com:443
+		# or GET http://example.com/ HTTP/1.1
+		def strip_port(host):
+			return host.rsplit(':', 1)[0] if host.count(':') == 1 else host
+
+		lines = data.split(b'\r\n\r\n')[0].decode('latin-1').split('\r\n')
+		request = lines[0].split(' ')
+		if len(request) > 1 and request[0] == 'CONNECT':
+			return (strip_port(request[1]), True)
+		if len(request) > 1 and '://' in request[1]:
+			return (strip_port(request[1].split('://', 1)[1].split('/', 1)[0]), False)
+		for line in lines[1:]:
+			(key, _, value) = line.partition(':')
+			if key.strip().lower() == 'host':
+				return (strip_port(value.strip()), False)
+		return ('', False)
+
+	@staticmethod
+	def _server_name(data):
+
+		# Return the server name indication (SNI) of a TLS ClientHello, '' if
+		# the ClientHello has none or is not TLS, or None if more data is
+		# needed. See: RFC 5246 section 7.4.1.2 and RFC 6066 section 3.
+		data = bytearray(data)
+		if len(data) < 5:
+			return None
+		if data[0] != 0x16:
+			return ''
+		end = 5 + (data[3] << 8 | data[4])
+		if len(data) < end:
+			return None
+		try:
+			if data[5] != 0x01:
+				return ''
+
+			# Skip handshake header, version, random, session id, cipher
+			# suites and compression methods
+			offset = 5 + 4 + 2 + 32
+			offset += 1 + data[offset]
+			offset += 2 + (data[offset] << 8 | data[offset + 1])
+			offset += 1 + data[offset]
+			extensions_end = min(end, offset + 2 + (data[offset] << 8 | data[offset + 1]))
+			offset += 2
+			while offset + 4 <= extensions_end:
+				kind = data[offset] << 8 | data[offset + 1]
+				length = data[offset + 2] << 8 | data[offset + 3]
+				offset += 4
+				if kind == 0x0000:
+					names_end = offset + 2 + (data[offset] << 8 | data[offset + 1])
+					offset += 2
+					while offset + 3 <= names_end:
+						name_length = data[offset + 1] << 8 | data[offset + 2]
+						if data[offset] == 0x00:
+							return bytes(data[offset + 3:offset + 3 + name_length]).decode('ascii', 'replace')
+						offset += 3 + name_length
+					return ''
+				offset += length
+		except IndexError:
+			pass
+		return ''
+
+# Verification
+# Checks blocked domains resolve to the blackhole address. The resolver is passed
+# in, so a stand-in resolver can be used instead of the system one.
+
+def resolve_address(domain):
+	import socket
+
+	# Return the IPv4 address the system resolver gives for the domain, or None
+	# if it does not resolve
+	try:
+		return socket.getaddrinfo(domain, None, socket.AF_INET)[0][4][0]
+	except (socket.error, IndexError, UnicodeError):
+		return None
+
+def verify_domains(domains, blackhole, resolve=resolve_address, threads=16, timeout=2.0, color=None):
+	import threading
+
+	# Resolve domains concurrently with resolve(domain), print a report and
+	# return the exit status, 1 if any domain did not resolve to the blackhole
+	# address in time. color(text, name) colors report labels.
+	if color is None:
+		color = lambda text, name: text
+	if not domains:
+		print('No blocked domains to verify')
+		return 0
+
+	# Lookups can't be interrupted, so daemon threads are left behind once
+	# every thread has had time for its share of lookups. Lookups still
+	# running then, or that took too long, are timeouts.
+	pending = list(reversed(domains))
+	results = {}
+	lock = threading.Lock()
+
+	def work():
+		while True:
+			with lock:
+				if not pending:
+					return
+				domain = pending.pop()
+			start = time.time()
+			address = resolve(domain)
+			with lock:
+				results[domain] = (address, time.time() - start)
+
+	workers = [threading.Thread(target=work) for _ in range(min(threads, len(domains)))]
+	for worker in workers:
+		worker.daemon = True
+		worker.start()
+	deadline = time.time() + timeout * (len(domains) // len(workers) + 1)
+	for worker in workers:
+		worker.join(max(0, deadline - time.time()))
+	with lock:
+		results = dict(results)
+
+	# Report
+	mismatches = []
+	timeouts = []
+	latencies = []
+	for domain in domains:
+		(address, elapsed) = results.get(domain, (None, None))
+		if elapsed is None or elapsed > timeout:
+			timeouts.append(domain)
+			continue
+		latencies.append(elapsed)
+		if address != blackhole:
+			mismatches.append((domain, address))
+
+	for (domain, address) in sorted(mismatches):
+		print(color('Mismatch', 'red') + ' {0} resolves to {1}, expected {2}'.format(domain, address or 'nothing', blackhole))
+	for domain in sorted(timeouts):
+		print(color('Timeout', 'yellow') + ' {0} did not resolve within {1}s'.format(domain, timeout))
+
+	latencies.sort()
+	def percentile(fraction):
+		if not latencies:
+			return 0
+		return latencies[int(round(fraction * (len(latencies) - 1)))] * 1000
+
+	print('Verified {0} domains: {1} blocked, {2} mismatched, {3} timed out. Resolution latency p50 {4:.1f}ms, p99 {5:.1f}ms'.format(len(domains), len(domains) - len(mismatches) - len(timeouts), len(mismatches), len(timeouts), percentile(0.5), percentile(0.99)))
+	if mismatches or timeouts:
+		print('Stale DNS caches can keep serving old addresses. Try flushing them, or wait a few minutes and verify again.')
+		return 1
+	return 0
+
+# Command line
+
+class Options(object):
+
+	# Stand-in for the argparse namespace when arguments are parsed without it
+	def __init__(self, **kwargs):
+		self.__dict__.update(kwargs)
 
 class Internet:
 
 	def __init__(self):
 
+		# Parse arguments. Cron jobs and plain updates skip argparse.
+		self.options = self._fast_arguments() or self._parse_arguments()
+
 		# Set variables
 		self.settings = {
-			'hosts_file': '/etc/hosts',
-			'hosts_file_original': '/etc/hosts.original',
-			'hosts_file_template': '/etc/hosts.template',
+			'hosts_file': self.options.hosts_file,
+			'hosts_file_original': self.options.hosts_file + '.original',
+			'hosts_file_template': self.options.hosts_file + '.template',
 			'hosts_file_blackhole': '127.0.0.250',
+			'config_cache_file': 'config.marshal',
+			'config_cache_version': 2,
+			'fragments_cache_file': 'fragments.marshal',
+			'fragments_cache_version': 3,
+			'fragments_parallel_bytes': 1048576,
+			'groups_cache_dir': 'groups',
+			'groups_cache_max_age': 7 * 24 * 3600,
+			'compiled_cache_dir': 'compiled',
+			'compiled_index_file': 'index.marshal',
+			'compiled_cache_version': 1,
+			'listen_hits_file': 'hits.json',
+			'listen_flush_interval': 60,
+			'listen_timeout': 5.0,
+			'verify_threads': 16,
+			'verify_timeout': 2.0,
+			'watch_debounce': 0.1,
+			'watch_latency': 1.0,
+			'watch_poll_interval': 1.0,
 			'timestamp': '[' + str(datetime.now()) + ']'
 		}
-		self.options = self._parse_arguments()
-		self.pp = pprint.PrettyPrinter(indent=4)
 
-		# Make setup function calls
-		self.data = self._load_json()
+		# The json storage file and drop-in directory are loaded on first use,
+		# see __getattr__() below
 
 		# Parse arguments via passed flags (above) or interactively (below)
 		if hasattr(self.options, 'interactive') and self.options.interactive != False:
@@ -366,81 +1143,211 @@ class Internet:
 
 		# The following can conflict with eachother.
 		# Allow only one to be executed per command.
+		if self.options.batch != None:
+			failed = not self.batch()
+		else:
+			failed = False
+			self._run_action()
+
+		# Second conflict group
+		if self.options.list != False:
+			self.list()
+
+		if self.options.stats != False:
+			self.stats()
+
+		# The following can be run without conflicts
+		if self.options.print_crontab != False:
+			self.print_crontab()
+
+		if self.options.compile != False:
+			self.compile()
+
+		if self.options.pac != None:
+			self.write_pac()
+
+		# Watch and listen run until interrupted
+		if self.options.watch != False:
+			self.watch()
+
+		if self.options.listen != False:
+			self.listen()
+
+		# Update if no arguments are passed
+		if self.options.update != False or len(sys.argv) == 1:
+			self.update_hosts(failed)
+
+		# Verify the current hosts file when not updating it
+		if self.options.verify != False:
+			sys.exit(0 if self.verify() and not failed else 1)
+
+		if failed:
+			sys.exit(1)
+
+	def __getattr__(self, name):
+
+		# Load groups when first used. Updates from a precompiled hosts file
+		# never use them.
+		if name == 'data':
+			self.data = self._load_json()
+			return self.data
+		if name == 'fragments':
+			self.fragments = self._load_fragments()
+			return self.fragments
+		raise AttributeError(name)
+
+	def _run_action(self):
+
+		# Run the group action set in options, return its result
 		if self.options.remove != False:
-			self.remove()
+			return self.remove()
 
 		elif self.options.empty != False:
-			self.empty()
+			return self.empty()
 
 		elif self.options.add != False:
-			self.add()
+			return self.add()
 
 		elif self.options.activate != False:
-			self.activate()
+			return self.activate()
 
 		elif self.options.deactivate != False:
-			self.deactivate()
+			return self.deactivate()
 
-		# Second conflict group
-		if self.options.list != False:
-			self.list()
+		return None
 
-		# The following can be run without conflicts
-		if self.options.print_crontab != False:
-			self.print_crontab()
+	def _defaults(self):
 
-		# Update if no arguments are passed
-		if self.options.update != False or len(sys.argv) == 1:
-			self.update_hosts()
+		# Default values of all options, shared by both argument parsers below
+		return {
+			'json_file': '{0}'.format(os.path.abspath(__file__ + '/../internet.json')),
+			'conf_dir': '{0}'.format(os.path.abspath(__file__ + '/../internet.d')),
+			'cache_dir': '{0}'.format(os.path.abspath(__file__ + '/../internet.cache')),
+			'hosts_file': '/etc/hosts',
+			'render_budget': 1000000,
+			'log_file': '{0}'.format(os.path.abspath(__file__ + '/../internet.log')),
+			'list': False,
+			'stats': False,
+			'update': False,
+			'batch': None,
+			'watch': False,
+			'confirm': False,
+			'activate': False,
+			'deactivate': False,
+			'remove': False,
+			'group': None,
+			'add': False,
+			'empty': False,
+			'domain': None,
+			'hour': None,
+			'day': None,
+			'no_color': False,
+			'pac': None,
+			'compile': False,
+			'verify': False,
+			'sample': 50,
+			'listen': False,
+			'listen_ports': '80,443',
+			'print_crontab': False,
+			'cron': False
+		}
+
+	def _fast_arguments(self):
+
+		# Parse the arguments used by cron jobs and plain updates without
+		# importing argparse and building the full parser. Returns None for
+		# anything else, which is left to _parse_arguments().
+		flags = {'--cron': 'cron', '-u': 'update', '--update': 'update'}
+		values = {'-f': 'json_file', '--file': 'json_file', '--conf-dir': 'conf_dir', '--cache-dir': 'cache_dir', '--hosts-file': 'hosts_file', '--log-file': 'log_file'}
+		options = Options(**self._defaults())
+		arguments = sys.argv[1:]
+		while arguments:
+			argument = arguments.pop(0)
+			if argument in flags:
+				setattr(options, flags[argument], True)
+			elif argument in values and arguments and not arguments[0].startswith('-'):
+				setattr(options, values[argument], arguments.pop(0))
+			else:
+				return None
+		return options
 
 	def _parse_arguments(self):
+		import argparse
 
 		# Create argparse instance
 		parser = argparse.ArgumentParser(description='A script to prevent connecting to domains according to custom time-based rules.', epilog='For time-based rules to work, this script needs to be executed via a cron job every hour. Basic functionality will work without cron job.')
 
 		# Setup arguments
 		setup = parser.add_argument_group('Setup options')
-		setup.add_argument('-f', '--file', default='{0}'.format(os.path.abspath(__file__ + '/../internet.json')), dest='json_file', metavar='<path>', help='Use specified json storage file.')
-		setup.add_argument('--log-file', default='{0}'.format(os.path.abspath(__file__ + '/../internet.log')), metavar='<path>', help='Use specified file as the cron job log file.')
+		setup.add_argument('-f', '--file', dest='json_file', metavar='<path>', help='Use specified json storage file.')
+		setup.add_argument('--conf-dir', metavar='<path>', help='Use specified directory of drop-in json files. Groups defined here are merged with the json storage file.')
+		setup.add_argument('--cache-dir', metavar='<path>', help='Use specified directory for cached data.')
+		setup.add_argument('--hosts-file', metavar='<path>', help='Use specified hosts file. The original and template hosts files are kept next to it.')
+		setup.add_argument('--render-budget', type=int, metavar='<domains>', help='Maximum number of domains to sort in memory when updating the hosts file. Larger lists are sorted in parts on disk.')
+		setup.add_argument('--log-file', metavar='<path>', help='Use specified file as the cron job log file.')
 
 		# General actions
 		general_actions = parser.add_argument_group('General actions')
-		general_actions.add_argument('-l', '--list', '--status', action='store_const', const=True, default=False, help='Display current groups, group fields and status.')
-		general_actions.add_argument('-u', '--update', action='store_const', default=False, const=True, help='Update hosts file.')
-		general_actions.add_argument('--confirm', action='store_const', default=False, const=True, help='Confirm hosts file before updating. Use with --update.')
+		general_actions.add_argument('-l', '--list', '--status', action='store_const', const=True, help='Display current groups, group fields and status.')
+		general_actions.add_argument('--stats', action='store_const', const=True, help='Display the number of domains in each group, how many are also in other groups, and the overlap between each pair of groups.')
+		general_actions.add_argument('-u', '--update', action='store_const', const=True, help='Update hosts file.')
+		general_actions.add_argument('-b', '--batch', metavar='<file|->', help='Apply group actions from a json lines file, or - for stdin. Saves the json storage file and updates the hosts file once for all actions.')
+		general_actions.add_argument('-w', '--watch', action='store_const', const=True, help='Keep running and update hosts file whenever the json storage file, drop-in directory or hosts template changes, and every hour.')
+		general_actions.add_argument('--verify', action='store_const', const=True, help='Verify blocked domains resolve to the blackhole address. Runs after the hosts file is updated when used with --update.')
+		general_actions.add_argument('--sample', type=int, metavar='<count>', help='Number of random blocked domains to verify, or 0 for all. Use with --verify.')
+		general_actions.add_argument('--compile', action='store_const', const=True, help='Render the hosts file for every hour of the week ahead of time. Later updates swap in the file for the current hour, and compile again when the json storage file, drop-in directory or hosts template changes.')
+		general_actions.add_argument('--confirm', action='store_const', const=True, help='Confirm hosts file before updating. Use with --update.')
 
 		# Group actions
 		group_actions = parser.add_argument_group('Actions on groups')
-		group_actions.add_argument('-A', '--activate', action='store_const', default=False, const=True, help='Activate a group.')
-		group_actions.add_argument('-D', '--deactivate', action='store_const', default=False, const=True, help='Deactivate a group.')
-		group_actions.add_argument('-r', '--remove', action='store_const', default=False, const=True, help='Remove a group. Warning: this permenantly removes all group information.')
+		group_actions.add_argument('-A', '--activate', action='store_const', const=True, help='Activate a group.')
+		group_actions.add_argument('-D', '--deactivate', action='store_const', const=True, help='Deactivate a group.')
+		group_actions.add_argument('-r', '--remove', action='store_const', const=True, help='Remove a group. Warning: this permenantly removes all group information.')
 
 		# Group arguments
 		groups = parser.add_argument_group('Group objects')
-		groups.add_argument('-g', '--group', default=None, metavar='<group>', help='Specify a group. Can be use in conjunction with actions like --add, --delete, etc.')
+		groups.add_argument('-g', '--group', metavar='<group>', help='Specify a group. Can be use in conjunction with actions like --add, --delete, etc.')
 
 		# Group field actions
 		field_actions = parser.add_argument_group('Actions on group fields. Specify a group with -g/--group')
-		field_actions.add_argument('-a', '--add', action='store_const', default=False, const=True, help='Add a group or group field object')
-		field_actions.add_argument('-e', '--empty', choices=['hours','domains','days'], default=False, help='Empty a specific group field.')
+		field_actions.add_argument('-a', '--add', action='store_const', const=True, help='Add a group or group field object')
+		field_actions.add_argument('-e', '--empty', choices=['hours','domains','days'], help='Empty a specific group field.')
 
 		# Group field object arguments
 		group_fields = parser.add_argument_group('Group field objects')
-		group_fields.add_argument('-d', '--domain', '--domains', default=None, metavar='<domain>', help='Specify a domain. Can be use in conjunction with group field actions like --add, --delete, etc. If no group (-g/--group) is specified, action will be on "default" group.')
-		group_fields.add_argument('-H', '--hour', '--hours', default=None, metavar='<hour-range>', help='Specify a group. Can be use in conjunction with group field actions like --add, --delete, etc. If no group (-g/--group) is specified, action will be on "default" group.')
-		group_fields.add_argument('-y', '--day', '--days', default=None, metavar='<full-day-name>', help='Specify an hour (e.g. 8) or hour range (e.g. 9-17). Times should be based on a 24 hour clock. Can be use in conjunction with actions like --add, --delete, etc. If no group (-g/--group) is specified, action will be on "default" group.')
+		group_fields.add_argument('-d', '--domain', '--domains', metavar='<domain>', help='Specify a domain. Can be use in conjunction with group field actions like --add, --delete, etc. If no group (-g/--group) is specified, action will be on "default" group.')
+		group_fields.add_argument('-H', '--hour', '--hours', metavar='<hour-range>', help='Specify a group. Can be use in conjunction with group field actions like --add, --delete, etc. If no group (-g/--group) is specified, action will be on "default" group.')
+		group_fields.add_argument('-y', '--day', '--days', metavar='<full-day-name>', help='Specify an hour (e.g. 8) or hour range (e.g. 9-17). Times should be based on a 24 hour clock. Can be use in conjunction with actions like --add, --delete, etc. If no group (-g/--group) is specified, action will be on "default" group.')
 
 		# Other options
 		others = parser.add_argument_group('Other options')
-		# others.add_argument('-i', '--interactive', action='store_const', default=False, const=True, help='Use interactive mode')
-		others.add_argument('--no-color', action='store_const', default=False, const=True, help='Do not display ascii colors in terminal.')
-		others.add_argument('--print-crontab', action='store_const', default=False, const=True, help='Display line to add to the crontab.')
-		others.add_argument('--cron', action='store_const', default=False, const=True, help='Opitmizes options for running script as a cron job.')
-
+		# others.add_argument('-i', '--interactive', action='store_const', const=True, help='Use interactive mode')
+		others.add_argument('--no-color', action='store_const', const=True, help='Do not display ascii colors in terminal.')
+		others.add_argument('--pac', metavar='<path>', help='Write a proxy auto-config (PAC) file blocking the domains currently in the hosts file, and their subdomains.')
+		others.add_argument('--listen', action='store_const', const=True, help='Keep running and answer connections to the blackhole address at once, counting hits per blocked domain in the cache directory.')
+		others.add_argument('--listen-ports', metavar='<http,https>', help='HTTP and HTTPS ports to listen on. Use with --listen.')
+		others.add_argument('--print-crontab', action='store_const', const=True, help='Display line to add to the crontab.')
+		others.add_argument('--cron', action='store_const', const=True, help='Opitmizes options for running script as a cron job.')
+
+		parser.set_defaults(**self._defaults())
 		return parser.parse_args()
 
 	def _load_json(self):
 
+		# Return the precompiled snapshot of the JSON file if the file has not
+		# changed since the snapshot was taken
+		snapshot_file = os.path.join(self.options.cache_dir, self.settings.get('config_cache_file'))
+		try:
+			stat = os.stat(self.options.json_file)
+			key = (self.settings.get('config_cache_version'), os.path.abspath(self.options.json_file), stat.st_mtime, stat.st_size)
+			f = open(snapshot_file, 'rb')
+			(cached_key, cached) = marshal.loads(f.read())
+			f.close()
+			if cached_key == key:
+				return Config.from_snapshot(cached)
+		except (IOError, OSError, EOFError, ValueError, TypeError):
+			pass
+
 		# Return JSON file contents, return a skeleton if file is empty or does not exist
 		if os.path.exists(self.options.json_file) and os.path.isfile(self.options.json_file):
 			f = open(self.options.json_file, 'r')
@@ -474,21 +1381,32 @@ class Internet:
 				print(self.settings.get('timestamp', '') + ' Could not write to JSON data file location: {0}. Do you have proper permissions?'.format(self.options.json_file))
 				sys.exit(1)
 
-		# Convert to JSON
-		# Set default value to return if keyname does not exist
-		# e.g.: file_json.get('keyname') will return {} now instead of None
-		# This lets us not do explicit checks before loops, etc
+		# Convert to JSON, then to groups
+		# Missing keys are treated as empty, this lets us not do explicit checks
+		# before loops, etc
+		import json
 		try:
 			file_json = json.loads(file_contents)
-			file_json.setdefault('groups', {})
-			file_json.setdefault('active', {})
 		except ValueError:
 			print(self.settings.get('timestamp', '') + ' Could not parse JSON data in file {0}. The data may be malformed.'.format(self.options.json_file))
 			sys.exit(1)
+		file_contents = None
+		config = Config.from_json(file_json)
+		file_json = None
+
+		# Save snapshot. The snapshot is only an optimization, failing to write
+		# it is not an error.
+		try:
+			stat = os.stat(self.options.json_file)
+			key = (self.settings.get('config_cache_version'), os.path.abspath(self.options.json_file), stat.st_mtime, stat.st_size)
+			self._write_cache(snapshot_file, (key, config.to_snapshot()))
+		except (IOError, OSError):
+			pass
 
-		return file_json
+		return config
 
 	def _save_json(self, raw_data):
+		import json
 		try:
 			# Turn on pretty printing of JSON
 			encoder = json.JSONEncoder(False, True, True, True, False, 4)
@@ -500,6 +1418,113 @@ class Internet:
 			print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Could not save JSON file: {0}'.format(self.settings.get('hosts_file')))
 			sys.exit(1)
 
+	def _save(self):
+
+		# Actions change group domains directly
+		for group in self.data.groups.values():
+			group.checksum = None
+
+		# Batches save once after all actions are applied
+		if self.options.batch != None:
+			return
+		self._save_json(self.data.to_json())
+		self._load_json()
+
+	def _load_fragments(self):
+
+		# Return merged contents of the drop-in directory, return an empty
+		# config if the directory is empty or does not exist
+		merged = Config()
+		try:
+			paths = sorted([os.path.join(self.options.conf_dir, name) for name in os.listdir(self.options.conf_dir) if name.endswith('.json') and not name.startswith('.')])
+		except OSError:
+			paths = []
+		if not paths:
+			return merged
+
+		# Key the cache on each fragment's name, modification time and size.
+		# If nothing changed since the last run, skip parsing entirely.
+		key = []
+		total_size = 0
+		for path in list(paths):
+			try:
+				stat = os.stat(path)
+			except OSError:
+
+				# Removed since the directory was listed
+				paths.remove(path)
+				continue
+			key.append((os.path.basename(path), stat.st_mtime, stat.st_size))
+			total_size += stat.st_size
+		key = (self.settings.get('fragments_cache_version'), os.path.abspath(self.options.conf_dir), tuple(key))
+
+		cache_file = os.path.join(self.options.cache_dir, self.settings.get('fragments_cache_file'))
+		try:
+			f = open(cache_file, 'rb')
+			(cached_key, cached) = marshal.loads(f.read())
+			f.close()
+			if cached_key == key:
+				return Config.from_snapshot(cached)
+		except (IOError, EOFError, ValueError, TypeError):
+			pass
+
+		# Parse fragments in parallel once there is enough data to make up for
+		# the cost of starting worker processes
+		import multiprocessing
+		if len(paths) > 1 and total_size >= self.settings.get('fragments_parallel_bytes') and multiprocessing.cpu_count() > 1:
+			pool = _pool(min(len(paths), multiprocessing.cpu_count()))
+			try:
+				results = pool.map(_read_fragment, paths)
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			results = [_read_fragment(path) for path in paths]
+
+		# Merge fragments in file name order
+		for (path, data) in results:
+			if data is None:
+				print(self.settings.get('timestamp', '') + ' Could not parse JSON data in file {0}. The data may be malformed.'.format(path))
+				sys.exit(1)
+			merged.merge(Config.from_json(marshal.loads(data)))
+
+		# Save cache. The cache is only an optimization, failing to write it is
+		# not an error.
+		try:
+			self._write_cache(cache_file, (key, merged.to_snapshot()))
+		except (IOError, OSError):
+			pass
+
+		return merged
+
+	def _write_cache(self, path, data):
+
+		# Write marshal data, replacing any previous file at once
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+		f = open(temporary, 'wb')
+		f.write(marshal.dumps(data))
+		f.close()
+		os.rename(temporary, path)
+
+	def _config(self):
+
+		# Return the json storage file merged with the drop-in directory.
+		# Fragment groups are read only, edits are saved to the json storage
+		# file only. Only groups defined in both are copied, the rest are
+		# shared, so the result must not be changed.
+		if not self.fragments.groups and not self.fragments.active:
+			return self.data
+		config = Config(dict(self.data.groups), self.data.active | self.fragments.active)
+		for name, group in self.fragments.groups.items():
+			if name in config.groups:
+				config.groups[name] = config.groups[name].copy()
+				config.groups[name].update(group)
+			else:
+				config.groups[name] = group
+		return config
+
 	def _init_hosts(self):
 
 		# Verify hosts file exists
@@ -509,6 +1534,7 @@ class Internet:
 
 		# Create hosts.original file
 		if not os.path.exists(self.settings.get('hosts_file_original')):
+			import shutil
 			try:
 				shutil.copy2(self.settings.get('hosts_file'), self.settings.get('hosts_file_original'))
 			except IOError:
@@ -517,55 +1543,42 @@ class Internet:
 
 		# Create hosts.template file
 		if not os.path.exists(self.settings.get('hosts_file_template')):
+			import shutil
 			try:
 				shutil.copy2(self.settings.get('hosts_file_original'), self.settings.get('hosts_file_template'))
 			except IOError:
 				print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Could not create template hosts file from: {0}'.format(self.settings.get('hosts_file')) + ' to: {0}'.format(self.settings.get('hosts_file_template')))
 				sys.exit(1)
 
-	def _is_live(self, groupname):
+	def _live_groups(self):
+
+		# Check active groups, verify each exists and is live
+		config = self._config()
+		return [config.groups.get(name) for name in config.active if config.groups.get(name) and self._is_live(name, config)]
+
+	def _live_domains(self, live=None):
+
+		# Use a set to collect a unique domain list from live groups
+		if live is None:
+			live = self._live_groups()
+		domains = set()
+		for group in live:
+			domains |= group.domains
+		return domains
+
+	def _is_live(self, groupname, config=None):
 
 		# Verify group exists
-		if not self.data.get('groups').get(groupname):
+		if config is None:
+			config = self._config()
+		if not config.groups.get(groupname):
 			return False
 		else:
-			group = self.data.get('groups').get(groupname)
+			group = config.groups.get(groupname)
 
-		# Set variables
+		# Verify current day and time fall in the group's days and hours
 		now = datetime.now()
-		hour = now.hour
-		day = {
-			0 : 'Monday',
-			1 : 'Tuesday',
-			2 : 'Wednesday',
-			3 : 'Thursday',
-			4 : 'Friday',
-			5 : 'Saturday',
-			6 : 'Sunday'
-		}.get(now.weekday(), '*')
-
-		# Verify current day falls in days list
-		in_day = False
-		if '*' in group.get('days'):
-			in_day = True
-		elif day in group.get('days', []):
-			in_day = True
-
-		# Verify current time falls in hours range
-		in_hours = False
-		if '*' in group.get('hours'):
-			in_hours = True
-		else:
-			for str in group.get('hours', []):
-				if re.search('\-', str):
-					(hour_start, _, hour_end) = str.partition('-')
-					if hour >= int(hour_start) and hour < int(hour_end):
-						in_hours = True
-				else:
-					if hour == str:
-						in_hours = True
-
-		return in_hours and in_day
+		return group.is_live(now.weekday(), now.hour)
 
 	# Actions
 
@@ -577,7 +1590,8 @@ class Internet:
 	def list(self):
 
 		# Determine if listing all or just one group
-		groups = self.data.get('groups')
+		config = self._config()
+		groups = config.groups
 		if self.options.group != None:
 			if groups.get(self.options.group):
 				groups = {self.options.group: groups.get(self.options.group)}
@@ -586,98 +1600,108 @@ class Internet:
 				return False
 
 		# Parse data
-		active = self.data.get('active')
-		for name, group in groups.iteritems():
+		active = config.active
+		for name in sorted(groups):
+			group = groups[name]
 			print('\nGroup: {0}\n'.format(name))
 
-			if active and name in active:
+			if name in active:
 				print('In Active List: ' + self.color('Yes', 'green'))
 				is_active = True
 			else:
 				print('In Active List: ' + self.color('No', 'red'))
 				is_active = False
 
-			if self._is_live(name) and is_active:
+			if self._is_live(name, config) and is_active:
 				print('Current Status: ' + self.color('Running', 'green') + '\n')
 			else:
 				print('Current Status: ' + self.color('Not Running', 'red') + '\n')
 
 			# Use join on list instead of using a for loop to print each value
-			print('Hours:\n\t' + '\n\t'.join(group.get('hours', {})) + '\n')
-			print('Days:\n\t' + '\n\t'.join(group.get('days', {})) + '\n')
-			print('Domains:\n\t' + '\n\t'.join(group.get('domains', {})) + '\n')
+			print('Hours:\n\t' + '\n\t'.join(sorted(group.hours)) + '\n')
+			print('Days:\n\t' + '\n\t'.join(sorted(group.days)) + '\n')
+			print('Domains:\n\t' + '\n\t'.join(sorted(group.domains)) + '\n')
+
+	def stats(self):
+
+		# Count domains by the set of groups listing them, then attribute each
+		# count to its groups and each pair of its groups
+		config = self._config()
+		(names, index) = config.domain_index()
+		counts = {}
+		for groups in index.values():
+			counts[groups] = counts.get(groups, 0) + 1
+		unique = [0] * len(names)
+		shared = [0] * len(names)
+		overlap = {}
+		for (groups, count) in counts.items():
+			bits = [bit for bit in range(len(names)) if groups >> bit & 1]
+			for position, bit in enumerate(bits):
+				if len(bits) == 1:
+					unique[bit] += count
+				else:
+					shared[bit] += count
+				for other in bits[position + 1:]:
+					overlap[(bit, other)] = overlap.get((bit, other), 0) + count
+
+		listed = sum(len(group.domains) for group in config.groups.values())
+		print('\n{0} domains in {1} groups, {2} listed by more than one group ({3} duplicate entries)\n'.format(len(index), len(names), sum(count for (groups, count) in counts.items() if groups & (groups - 1)), listed - len(index)))
+
+		width = max([len('Group')] + [len(name) for name in names])
+		print('{0:<{1}}  {2:>10}  {3:>10}  {4:>10}  Status'.format('Group', width, 'Domains', 'Unique', 'Shared'))
+		for bit, name in enumerate(names):
+			if name in config.active and self._is_live(name, config):
+				status = self.color('Running', 'green')
+			else:
+				status = self.color('Not Running', 'red')
+			print('{0:<{1}}  {2:>10}  {3:>10}  {4:>10}  {5}'.format(name, width, unique[bit] + shared[bit], unique[bit], shared[bit], status))
+
+		# Largest overlaps first. A group whose domains are all listed by
+		# another group can be removed.
+		if overlap:
+			print('\nOverlap between groups:')
+			for ((bit, other), count) in sorted(overlap.items(), key=lambda item: (-item[1], item[0])):
+				print('\t{0} and {1}: {2} domains ({3:.0f}% of {0}, {4:.0f}% of {1})'.format(names[bit], names[other], count, 100.0 * count / len(config.groups[names[bit]].domains), 100.0 * count / len(config.groups[names[other]].domains)))
+		print('')
 
 	def add(self):
+		import re
 
 		# Determine group. Create group if needed.
 		if not self.options.group:
 			groupname = 'default'
 		else:
 			groupname = self.options.group.lower()
-			if not self.data.get('groups').get(groupname):
-				self.data.get('groups')[groupname] = json.loads('''
-					{
-						"hours": ["*"],
-						"domains": [],
-						"days": ["*"]
-					}
-					''')
+		if groupname in self.fragments.groups:
+			print(self.color('Error', 'red') + ' Could not add to group, group is defined in the drop-in directory: {0}. Edit the file that owns the group instead.'.format(self.options.conf_dir))
+			return False
+		if groupname not in self.data.groups:
+			self.data.groups[groupname] = Group()
+		group = self.data.groups[groupname]
 
 		# Add hours to group if needed
 		if self.options.hour and re.search('[0-9-\*]', self.options.hour):
-
-			# Cache hours list for readability
-			hours = self.data.get('groups').get(groupname).get('hours')
-
-			# Determine how to add hours
-			if self.options.hour == '*':
-				hours = ['*']
-			elif '*' in self.data.get('groups').get(groupname).get('hours'):
-				hours = [self.options.hour]
-			else:
-				hours.append(self.options.hour)
-
-			# Filter uniques and sort before saving
-			hours = list(set(hours))
-			hours.sort()
-			self.data.get('groups').get(groupname)['hours'] = hours
+			group.add_hour(self.options.hour)
 
 		# Add days to group if needed
-		days_map = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday', '*']
-		if self.options.day and self.options.day in days_map:
-
-			# Cache days list for readability
-			days = self.data.get('groups').get(groupname).get('days')
-
-			# Determine how to add days
-			if self.options.day == '*':
-				days = ['*']
-			elif '*' in self.data.get('groups').get(groupname).get('days'):
-				days = [self.options.day]
-			else:
-				days.append(self.options.day)
-
-			# Filter uniques and sort before saving
-			days = list(set(days))
-			days.sort()
-			self.data.get('groups').get(groupname)['days'] = days
+		if self.options.day and (self.options.day in Group.days_map or self.options.day == '*'):
+			group.add_day(self.options.day)
 
 		# Add group domains if needed
 		if self.options.domain:
-			domain = self.options.domain.lower();
-			if re.match('http://', domain):
-				domain = domain[len('http://'):]
-			self.data.get('groups').get(groupname).get('domains').append(domain)
+			group.domains.add(Group.normalize(self.options.domain))
 
 		# Activate group by default
-		self.data.get('active').append(groupname)
+		self.data.active.add(groupname)
 
 		# Save and reload new information
-		self._save_json(self.data)
-		self._load_json()
+		self._save()
 		self.options.update = True
 
+		return True
+
 	def remove(self):
+		import re
 
 		# Verify group flag is set
 		if not self.options.group:
@@ -685,15 +1709,21 @@ class Internet:
 			return False
 
 		# Verify group exists
-		if not self.data.get('groups').get(self.options.group.lower()):
+		if self.options.group.lower() in self.fragments.groups:
+			print(self.color('Error', 'red') + ' Could not remove from group, group is defined in the drop-in directory: {0}. Edit the file that owns the group instead.'.format(self.options.conf_dir))
+			return False
+		if self.options.group.lower() not in self.data.groups:
 			print( self.color('Error', 'red') + ' Could not remove group, group does not exist: {0}'.format(self.options.group))
 			return False
 
 		# Remove group if no domain/day/hour field is specified
 		if not (self.options.day or self.options.domain or self.options.hour):
 
-			# Prompt for confirmation
-			command = raw_input('Are you sure you want to delete the group {0}? (y/n/quit): '.format(self.options.group)).lower()
+			# Prompt for confirmation. Batches are not interactive.
+			if self.options.batch != None:
+				command = 'y'
+			else:
+				command = raw_input('Are you sure you want to delete the group {0}? (y/n/quit): '.format(self.options.group)).lower()
 
 			# Verify input
 			if not re.match('(y|n|quit)', command):
@@ -707,33 +1737,32 @@ class Internet:
 				return False
 
 			# Remove group and update JSON
-			del self.data.get('groups')[self.options.group.lower()]
+			del self.data.groups[self.options.group.lower()]
+			self.data.active.discard(self.options.group.lower())
 
 		else:
 
 			# Cache group object
-			group = self.data.get('groups').get(self.options.group.lower())
+			group = self.data.groups[self.options.group.lower()]
 
 			# Remove day
-			if self.options.day != None and self.options.day in group.get('days'):
-				group['days'].remove(self.options.day)
+			if self.options.day != None:
+				group.days.discard(self.options.day)
 
 			# Remove domains
-			if self.options.domain != None and self.options.domain in group.get('domains'):
-				group['domains'].remove(self.options.domain)
+			if self.options.domain != None:
+				group.domains.discard(Group.normalize(self.options.domain))
 
 			# Remove hours
-			if self.options.hour != None and self.options.hour in group.get('hours'):
-				group['hours'].remove(self.options.hour)
-
-			# Save modified cache object
-			self.data.get('groups')[self.options.group.lower()] = group
+			if self.options.hour != None:
+				group.hours.discard(self.options.hour)
 
 		# Save and update hosts file
-		self._save_json(self.data)
-		self._load_json()
+		self._save()
 		self.options.update = True
 
+		return True
+
 	def empty(self):
 
 		# Verify group flag is set
@@ -742,108 +1771,271 @@ class Internet:
 			return False
 
 		# Verify group exists
-		if self.data.get('groups').get(self.options.group.lower()):
-			group = self.data.get('groups').get(self.options.group.lower())
+		if self.options.group.lower() in self.fragments.groups:
+			print(self.color('Error', 'red') + ' Could not empty group, group is defined in the drop-in directory: {0}. Edit the file that owns the group instead.'.format(self.options.conf_dir))
+			return False
+		if self.options.group.lower() in self.data.groups:
+			group = self.data.groups[self.options.group.lower()]
 		else:
 			print( self.color('Error', 'red') + ' Could not empty group, group does not exist: {0}'.format(self.options.group))
 			return False
 
 		# Check if other flags are set
 		if self.options.empty == 'days':
-			group['days'] = []
+			group.days.clear()
 
 		elif self.options.empty == 'domains':
-			group['domains'] = []
+			group.domains.clear()
 
 		elif self.options.empty == 'hours':
-			group['hours'] = []
+			group.hours.clear()
 
 		# Save changes
-		self._save_json(self.data)
-		self._load_json()
+		self._save()
 		self.options.update = True
 
+		return True
+
 	def activate(self):
 
-		# Add to active group
-		if (self.options.group != None and
-			self.options.group not in self.data.get('active') and
-			self.options.group in self.data.get('groups')):
+		# Verify group exists
+		if self.options.group in self.fragments.groups and self.options.group not in self.data.groups:
+			print(self.color('Error', 'red') + ' Could not activate group, group is defined in the drop-in directory: {0}. Edit the file that owns the group instead.'.format(self.options.conf_dir))
+			return False
+		if self.options.group == None or self.options.group not in self.data.groups:
+			print(self.color('Error', 'red') + ' Could not activate group, group does not exist: {0}'.format(self.options.group))
+			return False
 
-			data = self.data.get('active', [])
-			data.append(self.options.group)
-			self.data['active'] = data
+		# Add to active group
+		self.data.active.add(self.options.group)
 
 		# Save and reload new information
-		self._save_json(self.data)
-		self._load_json()
+		self._save()
+
+		return True
 
 	def deactivate(self):
 
-		# Remove from active group
-		if (self.options.group != None and
-			self.options.group in self.data.get('active') and
-			self.options.group in self.data.get('groups')):
+		# Verify group exists
+		if self.options.group in self.fragments.active:
+			print(self.color('Error', 'red') + ' Could not deactivate group, group is activated in the drop-in directory: {0}. Edit the file that owns the group instead.'.format(self.options.conf_dir))
+			return False
+		if self.options.group == None or self.options.group not in self.data.groups:
+			print(self.color('Error', 'red') + ' Could not deactivate group, group does not exist: {0}'.format(self.options.group))
+			return False
 
-			data = self.data.get('active', [])
-			data.remove(self.options.group)
-			self.data['active'] = data
+		# Remove from active group
+		self.data.active.discard(self.options.group)
 
 		# Save and reload new information
-		self._save_json(self.data)
-		self._load_json()
+		self._save()
 
-	def update_hosts(self):
+		return True
 
-		# Setup files if script hasn't run before
-		self._init_hosts()
+	def batch(self):
+		import json
+		import re
 
-		# Grab template file
+		# Read actions, one json object per line. Blank lines and lines
+		# starting with '#' are skipped.
 		try:
-			hosts_template = open(self.settings.get('hosts_file_template'), 'r')
-			template = hosts_template.read()
+			if self.options.batch == '-':
+				lines = sys.stdin.readlines()
+			else:
+				f = open(self.options.batch, 'r')
+				lines = f.readlines()
+				f.close()
 		except IOError:
-			print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Could not open hosts template file: {0}'.format(self.settings.get('hosts_file_template')))
+			print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Could not read batch file: {0}'.format(self.options.batch))
 			sys.exit(1)
 
-		# Create new content
-		disclaimer = '''
-##
-# WARNING
-#
-# This file has been dynamically created by the internet.py script. Any changes
-# made will be erased next time the file is generated. Add changes to the
-# /etc/hosts.template file.
-#
-# The original hosts file can be found at /etc/hosts.original. Be sure to
-# disable the internet.py script first!
-##
-'''
+		# Check every line before applying any of them
+		actions = []
+		errors = []
+		fields = ('group', 'domain', 'hour', 'day', 'field')
+		for number, line in enumerate(lines, 1):
+			line = line.strip()
+			if not line or line.startswith('#'):
+				continue
+			try:
+				action = json.loads(line)
+			except ValueError:
+				errors.append((number, 'could not parse JSON'))
+				continue
+			if not isinstance(action, dict):
+				errors.append((number, 'expected a JSON object'))
+				continue
+			unknown = [key for key in action if key != 'action' and key not in fields]
+			if action.get('action') not in ('add', 'remove', 'empty', 'activate', 'deactivate'):
+				errors.append((number, 'unknown action: {0}'.format(action.get('action'))))
+			elif unknown:
+				errors.append((number, 'unknown fields: {0}'.format(', '.join(sorted(unknown)))))
+			elif [key for key in fields if action.get(key) != None and not isinstance(action.get(key), type(u''))]:
+				errors.append((number, 'field values must be strings'))
+			elif action.get('action') == 'empty' and action.get('field') not in ('hours', 'domains', 'days'):
+				errors.append((number, 'empty requires a field of hours, domains or days'))
+			elif action.get('action') in ('remove', 'empty', 'activate', 'deactivate') and not action.get('group'):
+				errors.append((number, '{0} requires a group'.format(action.get('action'))))
+			elif action.get('hour') and not re.match(r'^(\*|[0-9]{1,2}(-[0-9]{1,2})?)$', action.get('hour')):
+				errors.append((number, 'invalid hour: {0}'.format(action.get('hour'))))
+			elif action.get('day') and action.get('day') not in Group.days_map and action.get('day') != '*':
+				errors.append((number, 'invalid day: {0}'.format(action.get('day'))))
+			else:
+				actions.append((number, action))
 
-		# Use a set to collect a unique domain list from active groups
-		domains = set()
-		active = self.data.get('active')
-		groups = self.data.get('groups')
+		if errors:
+			for (number, message) in errors:
+				print(self.color('Error', 'red') + ' Line {0}: {1}'.format(number, message))
+			print('No actions applied, {0} invalid line(s) in batch file: {1}'.format(len(errors), self.options.batch))
+			sys.exit(1)
 
-		# Check active groups, verify each exists and is live
-		# if so, add to domains list.
-		for name in active:
-			if groups.get(name) and self._is_live(name):
-				for domain in groups.get(name).get('domains', {}):
-					domains.add(domain)
-
-		# Turn back into a list, sort it, then create file lines
-		# Since we are using join, need to add an extra blackhole value at the
-		# beginning
+		# Apply all actions to the in-memory data
+		start = time.time()
+		applied = 0
+		for (number, action) in actions:
+			self.options.add = self.options.remove = self.options.activate = self.options.deactivate = False
+			self.options.empty = False
+			self.options.group = action.get('group')
+			self.options.domain = action.get('domain')
+			self.options.hour = action.get('hour')
+			self.options.day = action.get('day')
+			if action.get('action') == 'empty':
+				self.options.empty = action.get('field')
+			else:
+				setattr(self.options, action.get('action'), True)
+
+			description = ' '.join(['{0}={1}'.format(key, action.get(key)) for key in fields if action.get(key) != None])
+			if self._run_action():
+				applied += 1
+				print('Line {0}: {1} {2} '.format(number, action.get('action'), description) + self.color('OK', 'green'))
+			else:
+				print('Line {0}: {1} {2} '.format(number, action.get('action'), description) + self.color('Failed', 'red'))
+
+		# Save once for the whole batch, and update the hosts file once even
+		# for actions that don't on their own, e.g. activate
+		if applied > 0:
+			self._save_json(self.data.to_json())
+			self.options.update = True
+		elapsed = time.time() - start
+		print('Applied {0} of {1} actions in {2:.3f}s ({3:.0f} actions/second)'.format(applied, len(actions), elapsed, len(actions) / elapsed if elapsed > 0 else 0))
+
+		return applied == len(actions)
+
+	def update_hosts(self, failed=False):
+
+		# Exit with an error if an earlier action failed, e.g. a line of a
+		# batch, after updating for the actions that were applied
+		self._write_hosts()
+		if self.options.verify != False and not self.verify():
+			failed = True
+		sys.exit(1 if failed else 0)
+
+	def verify(self):
+		import random
+
+		# Pick a random sample of blocked domains, or all of them
+		domains = sorted(self._live_domains())
+		if self.options.sample > 0 and self.options.sample < len(domains):
+			domains = random.sample(domains, self.options.sample)
+		return verify_domains(domains, self.settings.get('hosts_file_blackhole'), resolve_address, self.settings.get('verify_threads'), self.settings.get('verify_timeout'), self.color) == 0
+
+	def watch(self):
+
+		# Watch is not interactive
+		self.options.confirm = False
+
+		# Use inotify on Linux, fall back to polling file stats elsewhere
+		files = [self.options.json_file, self.settings.get('hosts_file_template')]
+		directories = [self.options.conf_dir]
+		try:
+			if not sys.platform.startswith('linux'):
+				raise OSError('inotify is only available on Linux')
+			watcher = InotifyWatcher(files, directories)
+		except (OSError, AttributeError, TypeError):
+			watcher = PollingWatcher(files, directories, self.settings.get('watch_poll_interval'))
+		print(self.settings.get('timestamp', '') + ' Watching for changes using {0}: {1}'.format(watcher.__class__.__name__, ', '.join(files + directories)))
+
+		self._write_hosts()
+		while True:
+
+			# Wake up at the start of every hour for time based rules
+			now = datetime.now()
+			timeout = 3600 - (now.minute * 60 + now.second) + 1
+			changed = watcher.wait(timeout)
+			detected = time.time()
+
+			# Debounce bursts of writes. Wait until changes stop for a moment,
+			# but never longer than the latency bound.
+			while changed:
+				remaining = self.settings.get('watch_latency') - (time.time() - detected)
+				if remaining <= 0:
+					break
+				more = watcher.wait(min(self.settings.get('watch_debounce'), remaining))
+				if not more:
+					break
+				changed |= more
+
+			# Reload only what changed. Errors, e.g. a half written json file,
+			# are printed and the previous hosts file is kept until the next
+			# change.
+			self.settings['timestamp'] = '[' + str(datetime.now()) + ']'
+			try:
+				if os.path.abspath(self.options.json_file) in changed:
+					self.data = self._load_json()
+				if [path for path in changed if os.path.abspath(self.options.conf_dir) in (path, os.path.dirname(path))]:
+					self.fragments = self._load_fragments()
+				self._write_hosts()
+			except SystemExit:
+				continue
+			except (IOError, OSError) as error:
+				print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Could not update hosts file: {0}'.format(error))
+				sys.stdout.flush()
+				continue
+
+			# Report time from the last change on disk, or from detection
+			# if the files were removed, until the hosts file was written
+			mtimes = [os.stat(path).st_mtime for path in changed if os.path.exists(path)]
+			if not changed:
+				print(self.settings.get('timestamp', '') + ' Updated hosts file for the new hour')
+			else:
+				reaction = time.time() - (max(mtimes) if mtimes else detected)
+				print(self.settings.get('timestamp', '') + ' Updated hosts file {0:.0f}ms after change to: {1}'.format(reaction * 1000, ', '.join(sorted(changed))))
+			sys.stdout.flush()
+
+	def _write_hosts(self):
+
+		# Setup files if script hasn't run before
+		self._init_hosts()
+		header = self._header()
+
+		# Use the precompiled hosts file for this hour if there is one, see
+		# compile() below. Otherwise merge the cached, sorted domains of each
+		# live group into a rendered file. If the cache can't be used, lists
+		# larger than the render budget are sorted on disk and the rest are
+		# sorted in memory.
 		body = ''
-		if len(domains) > 0:
-			domains = list(domains)
-			domains.sort()
-			body += '\n{0}\t'.format(self.settings.get('hosts_file_blackhole'))
-			body += '\n{0}\t'.format(self.settings.get('hosts_file_blackhole')).join(domains)
+		compiled = self._compiled_hosts(header)
+		rendered = None
+		if compiled is None:
+			live = self._live_groups()
+			rendered = self._render_groups(live, header)
+			if rendered is None and sum(len(group.domains) for group in live) > self.options.render_budget:
+				rendered = self._render_external(live, header)
+			elif rendered is None:
+
+				# Turn back into a list, sort it, then create file lines
+				# Since we are using join, need to add an extra blackhole value at the
+				# beginning
+				domains = self._live_domains(live)
+				if len(domains) > 0:
+					domains = list(domains)
+					domains.sort()
+					body += '\n{0}\t'.format(self.settings.get('hosts_file_blackhole'))
+					body += '\n{0}\t'.format(self.settings.get('hosts_file_blackhole')).join(domains)
 
 		# Confirm file if requested
 		def confirm(hosts_content):
+			import re
 			print(hosts_content)
 
 			# Query user for confirmation
@@ -856,24 +2048,419 @@ class Internet:
 			if command == 'quit' or command == 'n':
 				sys.exit(0)
 
-		hosts_content = template + disclaimer + body
-		if self.options.confirm:
-			confirm(hosts_content)
-
-		# Write to hosts file
+		# Write to hosts file. The rendered file is removed even when the
+		# write fails or confirm exits.
 		try:
-			hosts_file = open(self.settings.get('hosts_file'), 'w')
-			hosts_file.write(hosts_content)
+			if self.options.confirm:
+				if compiled or rendered:
+					f = open(compiled or rendered, 'r')
+					confirm(f.read())
+					f.close()
+				else:
+					confirm(header + body)
+
+			if compiled:
+				self._swap_hosts(compiled)
+			elif rendered:
+
+				# Copy in place, keeping the hosts file's inode and permissions
+				self._copy_file(rendered, self.settings.get('hosts_file'))
+			else:
+				hosts_file = open(self.settings.get('hosts_file'), 'w')
+				hosts_file.write(header + body)
+				hosts_file.close()
 			if os.path.exists('/etc/init.d/nscd'):
+				from subprocess import call
 				call(['/etc/init.d/nscd', 'restart'])
 			elif os.path.exists('/usr/bin/dscacheutil'):
+				from subprocess import call
 				call(['/usr/bin/dscacheutil', '-flushcache'])
 			if self.options.cron:
 				print(self.settings.get('timestamp', '') + ' Successfully wrote to the hosts file: {0}'.format(self.settings.get('hosts_file')))
-			sys.exit(0)
 		except IOError:
 			print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Could not write to hosts file: {0}'.format(self.settings.get('hosts_file')))
 			sys.exit(1)
+		finally:
+			if rendered and os.path.exists(rendered):
+				os.remove(rendered)
+
+	def _header(self):
+
+		# Return the hosts template followed by the disclaimer
+		try:
+			hosts_template = open(self.settings.get('hosts_file_template'), 'r')
+			template = hosts_template.read()
+			hosts_template.close()
+		except IOError:
+			print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Could not open hosts template file: {0}'.format(self.settings.get('hosts_file_template')))
+			sys.exit(1)
+
+		disclaimer = '''
+##
+# WARNING
+#
+# This file has been dynamically created by the internet.py script. Any changes
+# made will be erased next time the file is generated. Add changes to the
+# {0} file.
+#
+# The original hosts file can be found at {1}. Be sure to
+# disable the internet.py script first!
+##
+'''.format(self.settings.get('hosts_file_template'), self.settings.get('hosts_file_original'))
+
+		return template + disclaimer
+
+	def _swap_hosts(self, path):
+
+		# Copy next to the hosts file and rename over it, so the hosts file is
+		# never seen half written. A symlinked hosts file is resolved so the
+		# link is kept and its target replaced. Falls back to copying in place
+		# where the hosts file can't be replaced with the same owner and
+		# extended attributes, e.g. when it is a mount point or labeled.
+		hosts_file = os.path.realpath(self.settings.get('hosts_file'))
+		temporary = '{0}.{1}.tmp'.format(hosts_file, os.getpid())
+		try:
+			stat = os.stat(hosts_file)
+			if hasattr(os, 'listxattr') and os.listxattr(hosts_file):
+				raise OSError('hosts file has extended attributes')
+			self._copy_file(path, temporary)
+			os.chmod(temporary, stat.st_mode & 0o7777)
+			os.chown(temporary, stat.st_uid, stat.st_gid)
+			os.rename(temporary, hosts_file)
+		except (IOError, OSError):
+			if os.path.exists(temporary):
+				os.remove(temporary)
+			self._copy_file(path, hosts_file)
+
+	def _copy_file(self, source, destination):
+		source = open(source, 'rb')
+		destination = open(destination, 'wb')
+		for chunk in iter(lambda: source.read(1048576), b''):
+			destination.write(chunk)
+		destination.close()
+		source.close()
+
+	def compile(self):
+
+		# Render the hosts file for every hour of the week ahead of time
+		start = time.time()
+		self._init_hosts()
+		slots = self._compile(self._header())
+		if slots is None:
+			print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Could not write compiled hosts files to: {0}'.format(os.path.join(self.options.cache_dir, self.settings.get('compiled_cache_dir'))))
+			sys.exit(1)
+		print(self.settings.get('timestamp', '') + ' Compiled {0} hourly slots into {1} distinct hosts files in {2:.3f}s'.format(len(slots), len(set(slots)), time.time() - start))
+
+	def _compile(self, header):
+		import hashlib
+
+		# Groups are live by weekday and hour only, so the hosts file can only
+		# change at the 168 hours of the week. Render each distinct set of
+		# live groups once, named by the checksum of its contents, and index
+		# the file to use for each hour. Returns the index, or None if the
+		# cache directory can not be used.
+		directory = os.path.join(self.options.cache_dir, self.settings.get('compiled_cache_dir'))
+		key = self._compile_key()
+		config = self._config()
+		masks = dict((name, (config.groups[name].day_mask(), config.groups[name].hour_mask())) for name in config.active if name in config.groups)
+		variants = {}
+		slots = []
+		try:
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			for weekday in range(7):
+				for hour in range(24):
+					live = tuple(sorted(name for (name, (day_mask, hour_mask)) in masks.items() if day_mask & (1 << weekday) and hour_mask & (1 << hour)))
+					if live not in variants:
+						rendered = self._render_groups([config.groups[name] for name in live], header)
+						if rendered is None:
+							return None
+						checksum = hashlib.sha1()
+						f = open(rendered, 'rb')
+						for chunk in iter(lambda: f.read(1048576), b''):
+							checksum.update(chunk)
+						f.close()
+						variants[live] = checksum.hexdigest() + '.hosts'
+						os.rename(rendered, os.path.join(directory, variants[live]))
+					slots.append(variants[live])
+
+			# Remove files of earlier configs, then save the index
+			for name in os.listdir(directory):
+				if name.endswith('.hosts') and name not in slots:
+					os.remove(os.path.join(directory, name))
+			self._write_cache(os.path.join(directory, self.settings.get('compiled_index_file')), (key, slots))
+		except (IOError, OSError):
+			return None
+		return slots
+
+	def _compiled_hosts(self, header):
+
+		# Return the compiled hosts file for the current hour, compiling again
+		# if the json storage file, drop-in directory or hosts template changed
+		# since. Returns None if the hosts file was never compiled, or the
+		# compiled files can't be used.
+		directory = os.path.join(self.options.cache_dir, self.settings.get('compiled_cache_dir'))
+		try:
+			f = open(os.path.join(directory, self.settings.get('compiled_index_file')), 'rb')
+			(key, slots) = marshal.loads(f.read())
+			f.close()
+		except (IOError, EOFError, ValueError, TypeError):
+			return None
+		if key != self._compile_key():
+			slots = self._compile(header)
+			if slots is None:
+				return None
+		now = datetime.now()
+		path = os.path.join(directory, slots[now.weekday() * 24 + now.hour])
+		return path if os.path.exists(path) else None
+
+	def _compile_key(self):
+
+		# Everything the compiled hosts files depend on, by modification time
+		# and size, so checking the key is cheap
+		def stat(path):
+			try:
+				stat = os.stat(path)
+				return (os.path.abspath(path), stat.st_mtime, stat.st_size)
+			except OSError:
+				return (os.path.abspath(path), None, None)
+		try:
+			fragments = sorted(name for name in os.listdir(self.options.conf_dir) if name.endswith('.json') and not name.startswith('.'))
+		except OSError:
+			fragments = []
+		return (
+			self.settings.get('compiled_cache_version'),
+			stat(self.options.json_file),
+			tuple(stat(os.path.join(self.options.conf_dir, name)) for name in fragments),
+			stat(self.settings.get('hosts_file_template')),
+			self.settings.get('hosts_file_original'),
+			self.settings.get('hosts_file_blackhole')
+		)
+
+	def _render_groups(self, groups, header):
+
+		# Render the hosts file from the sorted domains of each group, cached
+		# on disk by the checksum of the group's domains. Only groups that
+		# changed since they were last cached are sorted again. Returns None
+		# if the cache directory can not be used.
+		directory = os.path.join(self.options.cache_dir, self.settings.get('groups_cache_dir'))
+		try:
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			paths = []
+			for group in groups:
+				path = os.path.join(directory, group.digest() + '.domains')
+				if os.path.exists(path):
+					os.utime(path, None)
+				else:
+					self._sort_group(group, path)
+				paths.append(path)
+
+			# Remove cached groups that have not been used for a while
+			for name in os.listdir(directory):
+				path = os.path.join(directory, name)
+				if time.time() - os.path.getmtime(path) > self.settings.get('groups_cache_max_age'):
+					os.remove(path)
+
+			return self._render(paths, header, self.options.cache_dir)
+		except (IOError, OSError):
+			return None
+
+	def _sort_group(self, group, path):
+		import shutil
+		import tempfile
+
+		# Write the group's sorted domains, sorting on disk if the group is
+		# larger than the render budget
+		temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+		if len(group.domains) <= self.options.render_budget:
+			_write_run(group.domains, temporary)
+		else:
+			run_dir = tempfile.mkdtemp(prefix='internet-')
+			try:
+				runs = self._sort_runs([group], run_dir)
+				f = open(temporary, 'wb')
+				for domain in _merge_runs(runs):
+					f.write(domain + b'\n')
+				f.close()
+			finally:
+				shutil.rmtree(run_dir, True)
+		os.rename(temporary, path)
+
+	def _render_external(self, groups, header):
+		import shutil
+		import tempfile
+
+		# Render the hosts file to a temporary file without holding the whole
+		# sorted list in memory
+		run_dir = tempfile.mkdtemp(prefix='internet-')
+		try:
+			return self._render(self._sort_runs(groups, run_dir), header)
+		except (IOError, OSError):
+			print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Could not sort domains in temporary directory: {0}'.format(run_dir))
+			sys.exit(1)
+		finally:
+			shutil.rmtree(run_dir, True)
+
+	def _sort_runs(self, groups, run_dir):
+		import multiprocessing
+
+		# Collect domains in runs that fit the render budget. Each run is sorted
+		# by a forked process, so several runs are sorted at once while the
+		# next one is collected. Returns the paths of the sorted runs.
+		workers = max(1, multiprocessing.cpu_count())
+		run_size = max(1, self.options.render_budget // (workers + 1))
+		paths = []
+		running = []
+
+		def spill(run, path):
+			paths.append(path)
+			if workers > 1:
+				while len(running) >= workers:
+					finish(running.pop(0))
+				process = _pool_process(_write_run, (run, path))
+				process.start()
+				running.append(process)
+			else:
+				_write_run(run, path)
+
+		def finish(process):
+			process.join()
+			if process.exitcode != 0:
+				print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Could not sort domains in temporary directory: {0}'.format(run_dir))
+				sys.exit(1)
+
+		run = []
+		for group in groups:
+			for domain in group.domains:
+				run.append(domain)
+				if len(run) >= run_size:
+					spill(run, os.path.join(run_dir, 'run-{0}'.format(len(paths))))
+					run = []
+		if run:
+			spill(run, os.path.join(run_dir, 'run-{0}'.format(len(paths))))
+		while running:
+			finish(running.pop(0))
+
+		return paths
+
+	def _render(self, runs, header, directory=None):
+
+		# Merge sorted runs into a rendered temporary file, dropping domains
+		# found in more than one run. Matches the in memory output.
+		if not isinstance(header, bytes):
+			header = header.encode('utf-8')
+		prefix = '\n{0}\t'.format(self.settings.get('hosts_file_blackhole')).encode('utf-8')
+		if directory:
+			rendered = os.path.join(directory, 'hosts.{0}.tmp'.format(os.getpid()))
+			f = open(rendered, 'wb')
+		else:
+			import tempfile
+			(handle, rendered) = tempfile.mkstemp(prefix='internet-', suffix='.hosts')
+			f = os.fdopen(handle, 'wb')
+		f.write(header)
+		for domain in _merge_runs(runs):
+			f.write(prefix + domain)
+		f.close()
+		return rendered
+
+	def write_pac(self):
+		import json
+
+		# Browsers evaluate the PAC file on every request, so blocked domains
+		# are keys of an object instead of a chain of dnsDomainIs() checks.
+		# Each lookup walks the host's label suffixes, e.g. a.b.com, b.com,
+		# com, costing one lookup per label regardless of list size.
+		blocked = json.dumps(dict.fromkeys(self._live_domains(), 1), sort_keys=True, separators=(',', ':'))
+		pac = '''// This file has been dynamically created by the internet.py script. Any changes
+// made will be erased next time the file is generated.
+var blocked = {0};
+
+function FindProxyForURL(url, host) {{
+	var name = host.toLowerCase();
+	if (name.charAt(name.length - 1) == '.') {{
+		name = name.substring(0, name.length - 1);
+	}}
+	while (true) {{
+		if (blocked.hasOwnProperty(name)) {{
+			return '{1}';
+		}}
+		var dot = name.indexOf('.');
+		if (dot < 0) {{
+			return 'DIRECT';
+		}}
+		name = name.substring(dot + 1);
+	}}
+}}
+'''.format(blocked, 'PROXY {0}:80'.format(self.settings.get('hosts_file_blackhole')))
+
+		try:
+			f = open(self.options.pac, 'w')
+			f.write(pac)
+			f.close()
+		except IOError:
+			print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Could not write PAC file: {0}'.format(self.options.pac))
+			sys.exit(1)
+
+		if self.options.cron:
+			print(self.settings.get('timestamp', '') + ' Successfully wrote to the PAC file: {0}'.format(self.options.pac))
+
+	def listen(self):
+		import socket
+
+		# Listen on the blackhole address, where browsers end up for blocked
+		# domains, and periodically add the hits to the hits file
+		try:
+			(http_port, https_port) = [int(port) for port in self.options.listen_ports.split(',')]
+		except ValueError:
+			print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Listen ports should be an HTTP and an HTTPS port, e.g. 80,443. Received: {0}'.format(self.options.listen_ports))
+			sys.exit(1)
+		address = self.settings.get('hosts_file_blackhole')
+		try:
+			listener = BlackholeListener(address, [http_port], [https_port], self.settings.get('listen_timeout'))
+		except socket.error as error:
+			print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Could not listen on {0} ports {1}: {2}'.format(address, self.options.listen_ports, error))
+			sys.exit(1)
+
+		# Stop cleanly on kill, so the last hits are written
+		import signal
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+		print(self.settings.get('timestamp', '') + ' Listening on {0} ports {1}, writing hits to: {2}'.format(address, self.options.listen_ports, os.path.join(self.options.cache_dir, self.settings.get('listen_hits_file'))))
+		sys.stdout.flush()
+		listener.run(self.settings.get('listen_flush_interval'), self._write_hits)
+
+	def _write_hits(self, hits):
+		import json
+
+		# Add hits to the totals in the hits file, replacing it at once
+		path = os.path.join(self.options.cache_dir, self.settings.get('listen_hits_file'))
+		now = str(datetime.now())
+		totals = {'since': now, 'hits': {}}
+		try:
+			f = open(path, 'r')
+			totals = json.loads(f.read())
+			f.close()
+		except (IOError, ValueError):
+			pass
+		for (name, count) in hits.items():
+			totals['hits'][name] = totals['hits'].get(name, 0) + count
+		totals['updated'] = now
+
+		try:
+			if not os.path.isdir(self.options.cache_dir):
+				os.makedirs(self.options.cache_dir)
+			temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+			f = open(temporary, 'w')
+			f.write(json.dumps(totals, sort_keys=True, indent=4, separators=(',', ': ')))
+			f.close()
+			os.rename(temporary, path)
+		except (IOError, OSError):
+			print(self.settings.get('timestamp', '') + self.color(' Error', 'red') + ' Could not write hits file: {0}'.format(path))
+			return
+
+		print('[' + now + '] Counted {0} hits on {1} domains'.format(sum(hits.values()), len(hits)))
+		sys.stdout.flush()
 
 	def print_crontab(self):
 		filepath = os.path.abspath(__file__)
@@ -889,10 +2476,10 @@ class Internet:
 		try:
 			self.options.color_terminal
 		except AttributeError:
-			term = os.getenv('TERM')
-			if re.search('256', term, flags=re.IGNORECASE):
+			term = os.getenv('TERM', '').lower()
+			if '256' in term:
 				self.options.color_terminal = 256
-			elif re.search('color', term, flags=re.IGNORECASE):
+			elif 'color' in term:
 				self.options.color_terminal = 8
 			else:
 				self.options.color_terminal = False
@@ -938,6 +2525,3 @@ if __name__ == "__main__":
 	except KeyboardInterrupt:
 		print('')
 		sys.exit(1)
-else:
-	print('Error: Command line support only')
-	sys.exit(1)
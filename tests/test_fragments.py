@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+'''
+Tests that groups from the drop-in directory are read-only from the command
+line.
+
+Usage:
+$ python -m unittest discover tests
+'''
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from datetime import datetime
+
+SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'internet.py'))
+
+class DropInGroupTest(unittest.TestCase):
+
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp(prefix='internet-test-')
+		self.hosts = os.path.join(self.workdir, 'hosts')
+		f = open(self.hosts, 'w')
+		f.write('127.0.0.1\tlocalhost\n')
+		f.close()
+		self.json_file = os.path.join(self.workdir, 'internet.json')
+		conf_dir = os.path.join(self.workdir, 'internet.d')
+		os.mkdir(conf_dir)
+
+		# A drop-in group that is never live during the test
+		hour = (datetime.now().hour + 2) % 24
+		f = open(os.path.join(conf_dir, 'social.json'), 'w')
+		json.dump({'active': ['social'], 'groups': {'social': {'hours': ['{0}-{1}'.format(hour, hour + 1)], 'days': ['*'], 'domains': ['facebook.com']}}}, f)
+		f.close()
+		self.arguments = ['--file', self.json_file, '--conf-dir', conf_dir, '--cache-dir', os.path.join(self.workdir, 'internet.cache'), '--hosts-file', self.hosts, '--no-color']
+
+	def tearDown(self):
+		shutil.rmtree(self.workdir, True)
+
+	def run_script(self, *arguments):
+		process = subprocess.Popen([sys.executable, SCRIPT] + list(arguments) + self.arguments, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		output = process.communicate()[0].decode('utf-8')
+		return (process.returncode, output)
+
+	def assert_not_blocked(self):
+		self.run_script('--update')
+		f = open(self.hosts, 'r')
+		self.assertNotIn('facebook.com', f.read())
+		f.close()
+
+	def assert_no_shadow_group(self):
+		if os.path.exists(self.json_file):
+			f = open(self.json_file, 'r')
+			self.assertNotIn('social', json.loads(f.read()).get('groups', {}))
+			f.close()
+
+	def test_add_rejected(self):
+		(_, output) = self.run_script('--add', '--group', 'social', '--domain', 'twitter.com')
+		self.assertIn('Could not add to group, group is defined in the drop-in directory', output)
+		self.assert_no_shadow_group()
+		self.assert_not_blocked()
+
+	def test_remove_rejected(self):
+		(_, output) = self.run_script('--remove', '--group', 'social', '--domain', 'facebook.com')
+		self.assertIn('Could not remove from group, group is defined in the drop-in directory', output)
+		self.assert_no_shadow_group()
+		self.assert_not_blocked()
+
+	def test_empty_rejected(self):
+		(_, output) = self.run_script('--empty', 'hours', '--group', 'social')
+		self.assertIn('Could not empty group, group is defined in the drop-in directory', output)
+		self.assert_no_shadow_group()
+		self.assert_not_blocked()
+
+	def test_deactivate_rejected(self):
+		(_, output) = self.run_script('--deactivate', '--group', 'social')
+		self.assertIn('Could not deactivate group, group is activated in the drop-in directory', output)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+'''
+Tests that writing a compiled hosts file keeps a symlinked hosts file and its
+target's permissions.
+
+Usage:
+$ python -m unittest discover tests
+'''
+
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'internet.py'))
+
+class SwapHostsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp(prefix='internet-test-')
+		self.target = os.path.join(self.workdir, 'real_hosts')
+		f = open(self.target, 'w')
+		f.write('127.0.0.1\tlocalhost\n')
+		f.close()
+		os.chmod(self.target, 0o640)
+		self.hosts = os.path.join(self.workdir, 'hosts')
+		os.symlink('real_hosts', self.hosts)
+		self.arguments = ['--file', os.path.join(self.workdir, 'internet.json'), '--conf-dir', os.path.join(self.workdir, 'internet.d'), '--cache-dir', os.path.join(self.workdir, 'internet.cache'), '--hosts-file', self.hosts, '--no-color']
+
+	def tearDown(self):
+		shutil.rmtree(self.workdir, True)
+
+	def run_script(self, *arguments):
+		process = subprocess.Popen([sys.executable, SCRIPT] + list(arguments) + self.arguments, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		output = process.communicate()[0].decode('utf-8')
+		self.assertEqual(process.returncode, 0, output)
+
+	def test_symlink_kept(self):
+		self.run_script('--compile')
+		self.run_script('--update')
+		self.assertTrue(os.path.islink(self.hosts))
+		self.assertEqual(stat.S_IMODE(os.stat(self.target).st_mode), 0o640)
+		self.assertEqual([name for name in os.listdir(self.workdir) if name.endswith('.tmp')], [])
+		f = open(self.target, 'r')
+		self.assertIn('internet.py', f.read())
+		f.close()
+
+if __name__ == '__main__':
+	unittest.main()
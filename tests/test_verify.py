@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+'''
+Tests for verify_domains() with a stand-in resolver.
+
+Usage:
+$ python -m unittest discover tests
+'''
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import internet
+
+BLACKHOLE = '127.0.0.250'
+
+class StandInResolver(object):
+
+	# Resolves blocked.* names to the blackhole, wrong.* names elsewhere and
+	# hangs on hang.* names until released
+	def __init__(self):
+		self.release = threading.Event()
+
+	def __call__(self, domain):
+		if domain.startswith('hang.'):
+			self.release.wait(30)
+			return BLACKHOLE
+		if domain.startswith('wrong.'):
+			return '93.184.216.34'
+		if domain.startswith('missing.'):
+			return None
+		return BLACKHOLE
+
+class VerifyDomainsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.resolver = StandInResolver()
+		self.stdout = sys.stdout
+		sys.stdout = StringIO()
+
+	def tearDown(self):
+		self.resolver.release.set()
+		sys.stdout = self.stdout
+
+	def verify(self, domains, **kwargs):
+		start = time.time()
+		status = internet.verify_domains(domains, BLACKHOLE, self.resolver, **kwargs)
+		return (status, sys.stdout.getvalue(), time.time() - start)
+
+	def test_all_blocked(self):
+		(status, output, _) = self.verify(['blocked.a.com', 'blocked.b.com'], threads=2, timeout=1.0)
+		self.assertEqual(status, 0)
+		self.assertIn('Verified 2 domains: 2 blocked, 0 mismatched, 0 timed out', output)
+
+	def test_mismatches_and_timeout(self):
+		domains = ['blocked.a.com', 'blocked.b.com', 'wrong.c.com', 'missing.d.com', 'hang.e.com']
+		(status, output, elapsed) = self.verify(domains, threads=4, timeout=0.2)
+		self.assertEqual(status, 1)
+		self.assertIn('Verified 5 domains: 2 blocked, 2 mismatched, 1 timed out', output)
+		self.assertIn('Mismatch wrong.c.com resolves to 93.184.216.34, expected 127.0.0.250', output)
+		self.assertIn('Mismatch missing.d.com resolves to nothing, expected 127.0.0.250', output)
+		self.assertIn('Timeout hang.e.com did not resolve within 0.2s', output)
+
+		# A hung lookup must not hold up the report past the deadline
+		self.assertLess(elapsed, 1.0)
+
+	def test_no_domains(self):
+		(status, output, _) = self.verify([])
+		self.assertEqual(status, 0)
+		self.assertIn('No blocked domains to verify', output)
+
+if __name__ == '__main__':
+	unittest.main()